@@ -1,10 +1,286 @@
+import logging
+from email.Utils import formatdate, mktime_tz, parsedate_tz
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from zExceptions import BadRequest, NotFound
+from Acquisition import aq_base
 from Products.Five import BrowserView
 
 from ..service import service
+from ..dump import dump
+from ..jsonutils import json_to_datetime
+from ..walker import Walker
+from .. import compression
+from .. import jobs
+from .. import jsonutils
+from .. import profiling
+
+try:
+    from pareto.jsonexport.config import PROFILE_ENTRIES
+except ImportError:
+    # the amount of (slowest) timings reported when profiling
+    PROFILE_ENTRIES = 20
+
+try:
+    from pareto.jsonexport.config import CACHE_CONTROL
+except ImportError:
+    # clients have to revalidate every time (getting a 304 if nothing
+    # changed), shared caches may not store the export, since it is only
+    # available to authorized users
+    CACHE_CONTROL = 'private, max-age=0, must-revalidate'
+
+logger = logging.getLogger('pareto.jsonexport')
+
+
+def flag(value, default=False):
+    """ return a boolean for a request value
+
+        '', '0', 'false', 'no' and 'off' (in any case) are false, None
+        (the variable was not passed) results in default
+    """
+    if value is None:
+        return default
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(value)
+
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+    """ return True if the request can be answered with a 304
+
+        if_none_match and if_modified_since are the values of the request
+        headers (or None), etag and last_modified (a timestamp, 0 if
+        unknown) those of the current version of the export, as in HTTP
+        If-Modified-Since is ignored if If-None-Match is sent
+    """
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    if if_modified_since and last_modified:
+        parsed = parsedate_tz(if_modified_since)
+        if parsed is None:
+            return False
+        try:
+            since = mktime_tz(parsed)
+        except (TypeError, ValueError, OverflowError):
+            return False
+        return int(last_modified) <= since
+    return False
 
 
 class JsonView(BrowserView):
     def __call__(self):
+        response = self.request.RESPONSE
+        response.setHeader('Content-Type', 'application/json')
+        response.setHeader('Vary', 'Accept-Encoding')
+        codec = compression.negotiate(
+            self.request.get_header('Accept-Encoding'))
+        if self._not_modified(codec):
+            response.setStatus(304)
+            return ''
+        chunks = self._render()
+        if codec is not None:
+            response.setHeader('Content-Encoding', codec)
+            chunks = compression.compress_iter(chunks, codec)
+        if self.request.get('stream'):
+            service.write(chunks, response.write)
+            if (self.profile is not None and
+                    self.request.get('format') != 'jsonl'):
+                # no way to add the profile to a streamed JSON document
+                logger.info(
+                    'profile of %s: %s, counters: %s', self.request.URL,
+                    self.profile.to_json(PROFILE_ENTRIES),
+                    jsonutils.to_json(self.profile.counters))
+            return ''
+        ret = ''.join(chunks)
+        if self.walker is not None and self.walker.continuation is not None:
+            response.setHeader(
+                'X-JSON-Export-Continuation', self.walker.continuation)
+        if self.profile is not None:
+            response.setHeader(
+                'X-JSON-Export-Profile',
+                self.profile.to_json(PROFILE_ENTRIES))
+            response.setHeader(
+                'X-JSON-Export-Counters',
+                jsonutils.to_json(self.profile.counters))
+        return ret
+
+    def _not_modified(self, codec):
+        """ set the validator and cache headers, return True if the client
+            has the current version of the export
+
+            the validators are computed without serializing anything, see
+            service.validators, the ETag also depends on the query string
+            and the compression
+        """
+        if self._profiling():
+            return False
+        request = self.request
+        recursive = bool(
+            request.get('recursive') or request.get('catalog') or
+            request.get('since'))
+        last_modified, token = service.validators(self.context, recursive)
+        etag = '"%s"' % (md5('%s %s %s' % (
+            token, request.get('QUERY_STRING', ''), codec)).hexdigest(),)
+        response = request.RESPONSE
+        response.setHeader('ETag', etag)
+        if last_modified:
+            response.setHeader(
+                'Last-Modified', formatdate(last_modified, usegmt=True))
+        response.setHeader('Cache-Control', CACHE_CONTROL)
+        if_modified_since = request.get_header('If-Modified-Since')
+        if recursive:
+            # last modified doesn't change for everything that changes the
+            # export (e.g. workflow transitions of children), only the
+            # ETag does
+            if_modified_since = None
+        return not_modified(
+            request.get_header('If-None-Match'), if_modified_since, etag,
+            last_modified)
+
+    def _profiling(self):
+        return bool(
+            self.request.get('profile') or
+            self.request.get_header('X-JSON-Export-Profile'))
+
+    def _render(self):
+        """ return an iterable of the JSON chunks to respond with
+        """
+        self.walker = None
+        self.profile = None
+        if self._profiling():
+            self.profile = profiling.Profile()
+        fields = self._list_param('fields') or None
+        exclude = self._list_param('exclude') or None
+        if self.request.get('since'):
+            try:
+                since = json_to_datetime(self.request.get('since'))
+            except ValueError:
+                raise BadRequest('since should be a timestamp')
+            return dump([service.render_delta(
+                self.context, since, fields=fields, exclude=exclude)])
+        if self.request.get('catalog'):
+            return dump(service.render_brains_iter(
+                self.context, fields=fields or (), exclude=exclude))
+        recursive = self.request.get('recursive')
+        dedicated = bool(self.request.get('dedicated'))
+        self.walker = walker = Walker(
+            max_depth=self._int_param('max_depth'),
+            max_objects=self._int_param('max_objects'),
+            max_bytes=self._int_param('max_bytes'),
+            start=self.request.get('continuation'))
+        if self.request.get('format') == 'jsonl':
+            self.request.RESPONSE.setHeader(
+                'Content-Type', 'application/x-ndjson')
+            return dump(self._profile_trailer(service.render_jsonl_iter(
+                self.context, recursive=recursive, walker=walker,
+                profile=self.profile, dedicated=dedicated, fields=fields,
+                exclude=exclude)))
+        return dump(service.render_iter(
+            self.context, recursive=recursive, walker=walker,
+            profile=self.profile, dedicated=dedicated, fields=fields,
+            exclude=exclude))
+
+    def _profile_trailer(self, lines):
+        """ add a line with the profile to JSON Lines output when profiling
+
+            since the header can't be set once a stream has started
+        """
+        for line in lines:
+            yield line
+        if self.profile is not None and self.request.get('stream'):
+            yield '{"_profile": %s, "_counters": %s}\n' % (
+                self.profile.to_json(PROFILE_ENTRIES),
+                jsonutils.to_json(self.profile.counters))
+
+    def _list_param(self, name):
+        """ return a list from a comma-separated value (or a :list value)
+        """
+        value = self.request.get(name) or []
+        if isinstance(value, basestring):
+            value = value.split(',')
+        return [item.strip() for item in value if item.strip()]
+
+    def _int_param(self, name):
+        value = self.request.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise BadRequest('%s should be an integer' % (name,))
+
+
+class JobView(BrowserView):
+    """ background export jobs for the context, see the jobs module
+
+        'queue' (POST only) starts a job, 'status', 'resume' (POST only)
+        and 'download' take the job's 'id' as request variable
+    """
+    def queue(self):
+        if self.request.get('REQUEST_METHOD') != 'POST':
+            raise BadRequest('jobs can only be queued using POST')
+        status = jobs.queue(
+            self.context,
+            recursive=flag(self.request.get('recursive'), default=True))
+        return self._status_json(status)
+
+    def status(self):
+        status = self._get_status()
+        status['interrupted'] = jobs.is_stale(status)
+        return self._status_json(status)
+
+    def resume(self):
+        if self.request.get('REQUEST_METHOD') != 'POST':
+            raise BadRequest('jobs can only be resumed using POST')
+        status = self._get_status()
+        if jobs.is_stale(status):
+            # interrupted (e.g. by a restart), resume from the checkpoint
+            jobs.submit(aq_base(self.context)._p_jar.db(), status['id'])
+        return self._status_json(status)
+
+    def download(self):
+        status = self._get_status()
+        if status['state'] != jobs.DONE:
+            raise BadRequest('job %s is not done yet' % (status['id'],))
+        response = self.request.RESPONSE
+        response.setHeader('Content-Type', 'application/x-ndjson')
+        response.setHeader(
+            'Content-Disposition',
+            'attachment; filename="export-%s.jsonl"' % (status['id'],))
+        response.setHeader('Vary', 'Accept-Encoding')
+        fp = open(jobs.artifact_path(status['id']), 'rb')
+        try:
+            chunks = iter(lambda: fp.read(64 * 1024), '')
+            codec = compression.negotiate(
+                self.request.get_header('Accept-Encoding'))
+            if codec is not None:
+                response.setHeader('Content-Encoding', codec)
+                chunks = compression.compress_iter(chunks, codec)
+            else:
+                response.setHeader('Content-Length', str(status['bytes']))
+            service.write(chunks, response.write)
+        finally:
+            fp.close()
+        return ''
+
+    def _get_status(self):
+        try:
+            status = jobs.read_status(self.request.get('id'))
+        except ValueError:
+            status = None
+        if status is None:
+            raise NotFound('no such job')
+        return status
+
+    def _status_json(self, status):
+        status = dict(status)
+        if status['state'] == jobs.DONE:
+            status['download'] = '%s/@@json_export_job_download?id=%s' % (
+                self.context.absolute_url(), status['id'])
         self.request.RESPONSE.setHeader('Content-Type', 'application/json')
-        return service.render(
-            self.context, recursive=self.request.get('recursive'))
+        return jsonutils.to_json(status)
@@ -0,0 +1,119 @@
+import threading
+
+try:
+    from pareto.jsonexport.config import CACHE_SIZE
+except ImportError:
+    # approximate amount of bytes of serialized data to keep, 0 disables
+    CACHE_SIZE = 64 * 1024 * 1024
+
+# indexes in the linked list entries
+PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+
+class LRUCache(object):
+    """ thread-safe least-recently-used cache with a size budget
+
+        every value is stored with a size, when the total size exceeds
+        max_size the least recently used values are removed until it fits
+        again, values larger than max_size are not stored at all
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            # circular doubly linked list, most recently used first
+            self._root = root = [None, None, None, None, 0]
+            root[PREV] = root[NEXT] = root
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(entry)
+            self._link(entry)
+            return entry[VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size):
+        if size > self.max_size:
+            return
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[SIZE]
+            entry = self._data[key] = [None, None, key, value, size]
+            self._link(entry)
+            self.size += size
+            root = self._root
+            while self.size > self.max_size:
+                oldest = root[PREV]
+                self._unlink(oldest)
+                del self._data[oldest[KEY]]
+                self.size -= oldest[SIZE]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ return a dict with the cache statistics
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'items': len(self._data),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+    def _link(self, entry):
+        root = self._root
+        entry[PREV] = root
+        entry[NEXT] = root[NEXT]
+        root[NEXT][PREV] = entry
+        root[NEXT] = entry
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+
+def estimate_size(value):
+    """ return a rough estimate of the size of serialized data in bytes
+    """
+    if isinstance(value, basestring):
+        return len(value) + 2
+    elif isinstance(value, dict):
+        size = 2
+        for key, item in value.iteritems():
+            size += len(key) + 4 + estimate_size(item)
+        return size
+    elif isinstance(value, (list, tuple)):
+        size = 2
+        for item in value:
+            size += estimate_size(item) + 2
+        return size
+    return 16
+
+
+# the serialized data of objects, see Serializer.cached_to_dict()
+serialized = LRUCache(CACHE_SIZE)
@@ -0,0 +1,107 @@
+""" incremental compression of (streamed) exports
+
+    supports 'gzip' (using zlib) and, if the 'zstandard' package is
+    installed, 'zstd'
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from pareto.jsonexport.config import COMPRESSION_LEVELS
+except ImportError:
+    COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# file extensions per codec, for the offline export
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        # wbits 16 + MAX_WBITS generates a gzip header and trailer
+        self._compressobj = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def flush(self):
+        return self._compressobj.flush()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self._compressobj = zstandard.ZstdCompressor(
+            level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def flush(self):
+        return self._compressobj.flush()
+
+
+def codecs():
+    """ return the names of the available codecs, most preferred first
+    """
+    if zstandard is not None:
+        return ['zstd', 'gzip']
+    return ['gzip']
+
+
+def compressor(codec, level=None):
+    """ return a compressor (with compress() and flush() methods) for codec
+    """
+    if level is None:
+        level = COMPRESSION_LEVELS[codec]
+    if codec == 'gzip':
+        return GzipCompressor(level)
+    elif codec == 'zstd' and zstandard is not None:
+        return ZstdCompressor(level)
+    raise ValueError('unsupported codec %r' % (codec,))
+
+
+def compress_iter(chunks, codec, level=None):
+    """ generate the compressed data of the strings in chunks
+    """
+    compressobj = compressor(codec, level)
+    for chunk in chunks:
+        data = compressobj.compress(chunk)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+def negotiate(accept_encoding):
+    """ return the codec to use for an Accept-Encoding header value
+
+        returns None if no compression should be applied
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if name == 'x-gzip':
+            name = 'gzip'
+        accepted[name] = quality
+    best = None
+    best_quality = 0.0
+    for codec in codecs():
+        quality = accepted.get(codec, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best = codec
+            best_quality = quality
+    return best
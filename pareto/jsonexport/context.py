@@ -0,0 +1,160 @@
+import copy
+
+from Acquisition import aq_chain, aq_inner
+from zope.component.interfaces import ISite
+from Products.CMFCore.utils import getToolByName
+
+# keys that are serialized regardless of the projection
+STRUCTURAL_KEYS = frozenset(['type', 'id', 'path', '_children'])
+
+
+def find_site(obj):
+    """ return the nearest component site (e.g. the Plone site) containing
+        obj, None if there is none
+
+        exports run outside of a request (in scripts and worker threads)
+        should setSite() it, since local components (the registry that
+        collections use, schemaextenders) are only found through the site
+    """
+    for item in aq_chain(aq_inner(obj)):
+        if ISite.providedBy(item):
+            return item
+    return None
+
+
+class ExportContext(object):
+    """ state shared by the serializers of a single export
+
+        created by the service for every export (and on demand by
+        serializers used on their own), serializers get the context of the
+        serializer that created them (see Serializer.child_serializer), so
+        things that are the same for all objects in an export, like tool
+        lookups, are done only once
+
+        * site - any object inside the site, used to look up the tools
+
+        * walker - the walker.Walker of the export, if any, which holds the
+          limits and the amount of objects and bytes serialized
+
+        * profile - a profiling.Profile to record timings and counts in, or
+          None
+
+        * fields, exclude - the projection: if fields is not None only the
+          values with those keys are serialized, values with keys in
+          exclude are never serialized ('type', 'id', 'path' and
+          '_children' are always serialized), see wants() and project()
+    """
+    def __init__(
+            self, site, walker=None, profile=None, fields=None,
+            exclude=None):
+        self.site = site
+        self.walker = walker
+        self.profile = profile
+        self.fields = fields and frozenset(fields) or None
+        self.exclude = exclude and frozenset(exclude) or None
+        self._projected = {}
+        self._tools = {}
+        self._workflow_chains = {}
+        self._review_states = {}
+        self._portal_url = None
+
+    @property
+    def projection(self):
+        """ a hashable version of the projection, None if there is none
+        """
+        if self.fields is None and self.exclude is None:
+            return None
+        return (self.fields, self.exclude)
+
+    def projected(self, fields=None, exclude=None):
+        """ return a context with another projection that shares the rest
+            of the state (tools, caches, profile) with this one
+        """
+        ret = copy.copy(self)
+        ret.fields = fields and frozenset(fields) or None
+        ret.exclude = exclude and frozenset(exclude) or None
+        ret._projected = {}
+        return ret
+
+    def wants(self, key):
+        """ return True if the value with key key should be serialized
+        """
+        if key in STRUCTURAL_KEYS:
+            return True
+        if self.fields is not None and key not in self.fields:
+            return False
+        return self.exclude is None or key not in self.exclude
+
+    def project(self, items):
+        """ return the items (tuples starting with a key) that are wanted
+
+            used for serializer tables and field plans, the result is
+            memoized per items, so it costs (almost) nothing per object
+        """
+        if self.fields is None and self.exclude is None:
+            return items
+        memo = self._projected.get(id(items))
+        if memo is None or memo[0] is not items:
+            memo = self._projected[id(items)] = (items, tuple(
+                [item for item in items if self.wants(item[0])]))
+        return memo[1]
+
+    def count(self, name, amount=1):
+        """ add amount to counter name of the profile, if there is one
+        """
+        if self.profile is not None:
+            self.profile.count(name, amount)
+
+    @property
+    def portal_url(self):
+        """ the url of the portal, looked up only once
+        """
+        if self._portal_url is None:
+            self._portal_url = self.tool('portal_url')()
+        return self._portal_url
+
+    def tool(self, name, default=None):
+        """ return the tool with id name, or default if it doesn't exist
+        """
+        try:
+            return self._tools[name]
+        except KeyError:
+            pass
+        tool = self._tools[name] = getToolByName(self.site, name, default)
+        return tool
+
+    def workflow_chain(self, obj):
+        """ return the ids of the workflows for obj
+
+            the chain is cached per portal type, unless placeful workflow
+            policies are in use (then the chain depends on the location)
+        """
+        wft = self.tool('portal_workflow')
+        if self.tool('portal_placeful_workflow') is not None:
+            return tuple([wf.id for wf in wft.getWorkflowsFor(obj)])
+        portal_type = getattr(obj, 'portal_type', None)
+        chain = self._workflow_chains.get(portal_type)
+        if chain is None:
+            chain = self._workflow_chains[portal_type] = tuple(
+                [wf.id for wf in wft.getWorkflowsFor(obj)])
+        return chain
+
+    def review_state(self, parent_path, childid):
+        """ return the review state of a child of parent_path from the catalog
+
+            the states of all children of parent_path (a physical path) are
+            fetched with a single query the first time, returns None if the
+            catalog doesn't have a review state for the child
+        """
+        states = self._review_states.get(parent_path)
+        if states is None:
+            states = self._review_states[parent_path] = {}
+            catalog = self.tool('portal_catalog')
+            if catalog is not None:
+                brains = catalog.unrestrictedSearchResults(path={
+                    'query': '/'.join(parent_path), 'depth': 1})
+                for brain in brains:
+                    state = getattr(brain, 'review_state', None)
+                    if isinstance(state, basestring) and state:
+                        states[brain.getId] = state
+        return states.get(childid)
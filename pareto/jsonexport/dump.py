@@ -0,0 +1,72 @@
+""" optional dumping of generated JSON to files, for debugging
+
+    disabled by default, set DUMP_DIRECTORY in 'pareto.jsonexport.config'
+    to a directory to have the JSON of every export written to a file in
+    that directory (exports larger than DUMP_MAX_SIZE bytes are skipped)
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+
+try:
+    from pareto.jsonexport.config import DUMP_DIRECTORY
+except ImportError:
+    DUMP_DIRECTORY = None
+
+try:
+    from pareto.jsonexport.config import DUMP_MAX_SIZE
+except ImportError:
+    DUMP_MAX_SIZE = 10 * 1024 * 1024
+
+logger = logging.getLogger('pareto.jsonexport')
+
+_counter = itertools.count()
+
+
+def dump(chunks, name='export'):
+    """ return an iterable over the strings in chunks
+
+        if dumping is enabled, the chunks are collected while iterating,
+        and once the iterable is exhausted, they are written to a new file
+        in DUMP_DIRECTORY from a separate thread
+    """
+    if not DUMP_DIRECTORY:
+        return chunks
+    return _collect(chunks, name)
+
+
+def _collect(chunks, name):
+    collected = []
+    size = 0
+    for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            if size > DUMP_MAX_SIZE:
+                collected = None
+            else:
+                collected.append(chunk)
+        yield chunk
+    if collected is None:
+        logger.info(
+            'not dumping %s JSON of %s bytes, DUMP_MAX_SIZE is %s',
+            name, size, DUMP_MAX_SIZE)
+        return
+    path = os.path.join(DUMP_DIRECTORY, '%s-%s-%s-%s.json' % (
+        name, time.strftime('%Y%m%d-%H%M%S'), os.getpid(), _counter.next()))
+    thread = threading.Thread(target=_write, args=(path, collected))
+    thread.setDaemon(True)
+    thread.start()
+
+
+def _write(path, chunks):
+    try:
+        fp = open(path, 'wb')
+        try:
+            for chunk in chunks:
+                fp.write(chunk)
+        finally:
+            fp.close()
+    except (IOError, OSError):
+        logger.exception('error dumping JSON to %s', path)
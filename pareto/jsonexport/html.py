@@ -22,32 +22,50 @@ FORMATTERS = {
 }
 
 def html_to_text(html):
+    """ return a plain text version of html
+
+        the html is parsed once, and the tree is walked depth-first using an
+        explicit stack: the text of an element is the concatenation of that
+        of its children, passed through the FORMATTERS function for the
+        element if there is one, block elements (BLOCKELS) without formatter
+        are followed by a newline
+    """
     soup = BeautifulSoup.BeautifulSoup(html)
-    ret = []
-    for tag in soup.contents:
-        if isinstance(tag, basestring):
-            ret.append(tag)
+    # frames of (element, iterator over its children, text parts)
+    stack = [(soup, iter(soup.contents), [])]
+    while True:
+        tag, children, parts = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            if isinstance(child, basestring):
+                parts.append(child)
+            else:
+                stack.append((child, iter(child.contents), []))
             continue
+        stack.pop()
+        content = u''.join(parts)
+        if not stack:
+            return content
+        parts = stack[-1][2]
         name = tag.name.lower()
         formatter = FORMATTERS.get(name)
         if formatter is not None:
-            ret.append(
-                formatter(
-                    tag,
-                    html_to_text(u''.join(unicode(c) for c in tag.contents))))
+            parts.append(formatter(tag, content))
         else:
-            ret.append(
-                html_to_text(u''.join(unicode(c) for c in tag.contents)))
+            parts.append(content)
             if name in BLOCKELS:
-                ret.append('\n')
-    return ''.join(ret)
+                parts.append('\n')
 
-def _get_sources(mediael):
-    src = dict(mediael.attrs).get('src')
-    if src:
-        return [src]
-    else:
-        return [dict(tag.attrs)['src'] for tag in mediael.findAll('source')]
+# the elements urls_from_html gets the urls from, and their url attribute
+URL_ATTRIBUTES = {
+    'a': 'href',
+    'img': 'src',
+    'embed': 'src',
+    'iframe': 'src',
+    'audio': 'src',
+    'video': 'src',
+}
+MEDIAELS = ('audio', 'video')
 
 def urls_from_html(html):
     """ return a dict with urls
@@ -57,16 +75,29 @@ def urls_from_html(html):
         are lists of strings, except for 'audio' and 'video', where it's
         lists of lists of strings (since each audio or video tag can have
         multiple sources)
+
+        all elements are found in a single pass over the document, elements
+        without url (e.g. anchors without href) are skipped, as are the
+        'source' elements of audio and video elements that have a 'src'
     """
-    ret = {}
+    ret = dict([(tagname, []) for tagname in URL_ATTRIBUTES])
     soup = BeautifulSoup.BeautifulSoup(html)
-    for tagname in ('a', 'img', 'embed', 'iframe', 'audio', 'video'):
-        tags = soup.findAll(tagname)
-        if tagname == 'a':
-            value = [dict(tag.attrs)['href'] for tag in tags]
-        elif tagname in ('audio', 'video'):
-            value = [_get_sources(tag) for tag in tags]
-        else:
-            value = [dict(tag.attrs)['src'] for tag in tags]
-        ret[tagname] = value
+    # the sources of the audio and video elements without src, by element
+    sources = {}
+    for tag in soup.findAll(URL_ATTRIBUTES.keys() + ['source']):
+        name = tag.name
+        if name == 'source':
+            mediael = tag.findParent(MEDIAELS)
+            src = tag.get('src')
+            if src and id(mediael) in sources:
+                sources[id(mediael)].append(src)
+            continue
+        url = tag.get(URL_ATTRIBUTES[name])
+        if name in MEDIAELS:
+            if url:
+                ret[name].append([url])
+            else:
+                ret[name].append(sources.setdefault(id(tag), []))
+        elif url:
+            ret[name].append(url)
     return ret
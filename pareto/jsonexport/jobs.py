@@ -0,0 +1,313 @@
+""" background export jobs
+
+    a job exports an object and everything below it to a JSON Lines file
+    (see walker.Walker.iter_jsonl), outside of a web request, in batches:
+    after every batch the file is synced and the progress (the
+    continuation token of the walker and the size of the file) is
+    checkpointed, so an interrupted job resumes where it left off rather
+    than starting over
+
+    jobs are queued using queue(), and run one at a time by a worker thread
+    that uses its own database connection, or can be run (or resumed) in a
+    separate process using the Zope instance script:
+
+      bin/instance run path/to/pareto/jsonexport/jobs.py <job id>
+
+    every job has a directory in JOBS_DIRECTORY containing the status of
+    the job ('status.json'), the export ('export.jsonl') and a lock file
+    ('lock'), which is locked while the job runs, so a job is never run by
+    two threads or processes at the same time
+"""
+import os
+import sys
+import errno
+import fcntl
+import time
+import uuid
+import Queue
+import logging
+import tempfile
+import threading
+
+import transaction
+from Acquisition import aq_base
+from zope.component.hooks import getSite, setSite
+
+# absolute imports, since this module can be run as a script
+from pareto.jsonexport import jsonutils
+from pareto.jsonexport.context import ExportContext, find_site
+from pareto.jsonexport.serializers import get_serializer
+from pareto.jsonexport.walker import Walker
+
+try:
+    from pareto.jsonexport.config import JOBS_DIRECTORY
+except ImportError:
+    JOBS_DIRECTORY = os.path.join(
+        tempfile.gettempdir(), 'pareto.jsonexport.jobs')
+
+try:
+    from pareto.jsonexport.config import JOB_BATCH_SIZE
+except ImportError:
+    # the amount of objects exported between checkpoints
+    JOB_BATCH_SIZE = 500
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger('pareto.jsonexport')
+
+# the jobs queued or being run by the worker thread of this process
+_queue = Queue.Queue()
+_worker = None
+_running = set()
+_lock = threading.Lock()
+
+
+def job_directory(jobid):
+    # job ids are passed in requests, make sure they can't point elsewhere
+    if not jobid or not jobid.isalnum():
+        raise ValueError('invalid job id %r' % (jobid,))
+    return os.path.join(JOBS_DIRECTORY, jobid)
+
+
+def artifact_path(jobid):
+    """ return the path of the export file of job jobid
+    """
+    return os.path.join(job_directory(jobid), 'export.jsonl')
+
+
+def read_status(jobid):
+    """ return the status (a dict) of job jobid, None if it doesn't exist
+    """
+    path = os.path.join(job_directory(jobid), 'status.json')
+    if not os.path.exists(path):
+        return None
+    return jsonutils.json.loads(open(path, 'rb').read())
+
+
+def write_status(status):
+    """ store status (atomically)
+    """
+    status['updated'] = time.time()
+    path = os.path.join(job_directory(status['id']), 'status.json')
+    fp = open(path + '.tmp', 'wb')
+    try:
+        fp.write(jsonutils.to_json(status))
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+    os.rename(path + '.tmp', path)
+
+
+def create(root, recursive=True):
+    """ create a job to export root, return its status
+
+        the job is not started, see queue()
+    """
+    jobid = uuid.uuid4().hex
+    os.makedirs(job_directory(jobid))
+    status = {
+        'id': jobid,
+        'root': '/'.join(root.getPhysicalPath()),
+        'recursive': bool(recursive),
+        'state': QUEUED,
+        'created': time.time(),
+        'objects': 0,
+        'bytes': 0,
+        'checkpoint': None,
+        'error': None,
+    }
+    write_status(status)
+    return status
+
+
+def queue(root, recursive=True):
+    """ create a job to export root and have the worker thread run it
+
+        returns the status of the job
+    """
+    status = create(root, recursive)
+    submit(aq_base(root)._p_jar.db(), status['id'])
+    return status
+
+
+def submit(db, jobid):
+    """ have the worker thread run (or resume) job jobid using database db
+
+        returns False if the job is already queued or running
+    """
+    global _worker
+    _lock.acquire()
+    try:
+        if jobid in _running:
+            return False
+        _running.add(jobid)
+        _queue.put((db, jobid))
+        if _worker is None or not _worker.isAlive():
+            _worker = threading.Thread(
+                target=_work, name='pareto.jsonexport jobs')
+            _worker.setDaemon(True)
+            _worker.start()
+    finally:
+        _lock.release()
+    return True
+
+
+def is_stale(status):
+    """ return True if status is that of an interrupted job
+
+        that is a job that is not done or failed, but is not queued in
+        this process nor being run by any thread or process
+    """
+    return (
+        status['state'] in (QUEUED, RUNNING) and
+        status['id'] not in _running and not is_locked(status['id']))
+
+
+def lock(jobid):
+    """ lock job jobid, return the (open) lock file, None if it's locked
+
+        the lock is released when the file is closed (or the process ends)
+    """
+    fp = open(os.path.join(job_directory(jobid), 'lock'), 'a')
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        fp.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fp
+
+
+def is_locked(jobid):
+    """ return True if job jobid is being run
+    """
+    fp = lock(jobid)
+    if fp is None:
+        return True
+    fp.close()
+    return False
+
+
+def _work():
+    while True:
+        db, jobid = _queue.get()
+        try:
+            connection = db.open()
+            try:
+                run(connection.root()['Application'], jobid)
+            finally:
+                transaction.abort()
+                connection.cacheMinimize()
+                connection.close()
+        except Exception:
+            logger.exception('export job %s failed', jobid)
+        _lock.acquire()
+        try:
+            _running.discard(jobid)
+        finally:
+            _lock.release()
+
+
+def run(app, jobid, batch_size=None, sync=True):
+    """ run job jobid, or resume it from its last checkpoint
+
+        app is the Zope application, if sync is true a new transaction is
+        started for every batch, so the batches see the latest data (and
+        old revisions don't have to be kept around), returns the status
+
+        if the job is being run by another thread or process already,
+        nothing is done
+    """
+    lockfile = lock(jobid)
+    if lockfile is None:
+        logger.info('export job %s is running elsewhere', jobid)
+        return read_status(jobid)
+    try:
+        return _run(app, jobid, batch_size, sync)
+    finally:
+        lockfile.close()
+
+
+def _run(app, jobid, batch_size, sync):
+    from Testing.makerequest import makerequest
+    status = read_status(jobid)
+    if status['state'] == DONE:
+        return status
+    status['state'] = RUNNING
+    status['error'] = None
+    write_status(status)
+    site = getSite()
+    try:
+        root = makerequest(app).unrestrictedTraverse(status['root'])
+        # jobs run outside of requests, set the site so local components
+        # (e.g. the registry collections use) can be found
+        setSite(find_site(root))
+        path = artifact_path(jobid)
+        fp = open(path, os.path.exists(path) and 'r+b' or 'wb')
+        try:
+            # discard whatever was written after the last checkpoint
+            fp.seek(status['bytes'])
+            fp.truncate()
+            while True:
+                if sync:
+                    transaction.begin()
+                more = run_batch(root, status, fp, batch_size)
+                write_status(status)
+                if not more:
+                    break
+        finally:
+            fp.close()
+            setSite(site)
+    except Exception, e:
+        status['state'] = FAILED
+        status['error'] = '%s: %s' % (e.__class__.__name__, e)
+        write_status(status)
+        raise
+    status['state'] = DONE
+    write_status(status)
+    return status
+
+
+def run_batch(root, status, fp, batch_size=None):
+    """ write the next batch of objects of the job to file fp
+
+        updates the 'objects', 'bytes' and 'checkpoint' values of status
+        (but doesn't store it), returns True if there are more objects
+    """
+    if batch_size is None:
+        batch_size = JOB_BATCH_SIZE
+    walker = Walker(max_objects=batch_size, start=status['checkpoint'])
+    serializer = get_serializer(root, ExportContext(root, walker))
+    for path, child, data, parent in walker.iter_objects(
+            serializer, status['recursive']):
+        if walker.is_ancestor(path):
+            # written by an earlier batch
+            continue
+        fp.write(walker.jsonl_line(child, data, parent))
+        status['objects'] += 1
+    fp.flush()
+    os.fsync(fp.fileno())
+    status['bytes'] = fp.tell()
+    status['checkpoint'] = walker.continuation
+    return walker.continuation is not None
+
+
+def main(app, argv):
+    if not argv:
+        print 'usage: jobs.py <job id> [<job id> ...]'
+        sys.exit(1)
+    for jobid in argv:
+        status = run(app, jobid)
+        transaction.abort()
+        print 'job %s: %s objects exported to %s' % (
+            jobid, status['objects'], artifact_path(jobid))
+
+
+if __name__ == '__main__':
+    from pareto.jsonexport.jobs import main
+    main(app, sys.argv[1:])
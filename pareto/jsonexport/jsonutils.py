@@ -1,9 +1,34 @@
-try:
-    import json
-except ImportError:
-    import simplejson as json
 import datetime
+import inspect
+import re
+import time
 from DateTime import DateTime
+from DateTime.interfaces import DateTimeError
+
+try:
+    from pareto.jsonexport.config import JSON_BACKEND
+except ImportError:
+    # name of the json module to use (e.g. 'simplejson'), None for the
+    # stdlib json module
+    JSON_BACKEND = None
+
+
+def _load_backend(name):
+    if name is None:
+        # simplejson is only used when asked for: its output and parsing
+        # differ in details (e.g. it encodes Decimals, and loads() returns
+        # str rather than unicode for ASCII strings)
+        name = 'json'
+    try:
+        return __import__(name)
+    except ImportError:
+        if name != 'json':
+            raise
+        # Python 2.5
+        import simplejson
+        return simplejson
+
+json = _load_backend(JSON_BACKEND)
 
 def datetime_to_json(dt):
     if isinstance(dt, datetime.date):
@@ -11,18 +36,100 @@ def datetime_to_json(dt):
     else:
         return dt.strftime('%Y%m%d-%H%M%S')
 
+def json_to_datetime(value):
+    """ return a DateTime for a string in the format of datetime_to_json
+
+        falls back to DateTime's own parsing for other formats, raises
+        ValueError if value can not be parsed
+    """
+    for format in ('%Y%m%d-%H%M%S', '%Y%m%d'):
+        try:
+            return DateTime(*time.strptime(value, format)[:6])
+        except ValueError:
+            pass
+    try:
+        return DateTime(value)
+    except DateTimeError:
+        raise ValueError('can not parse datetime %r' % (value,))
+
 json_serializers = [
     (datetime.datetime, datetime_to_json),
     (datetime.date, datetime_to_json),
     (DateTime, datetime_to_json),
 ]
 
+class RawJSON(object):
+    """ a pre-encoded JSON fragment
+
+        to_json() inserts the fragment into its output verbatim, this allows
+        re-using the JSON of (e.g.) cached objects without encoding them again
+    """
+    __slots__ = ('json',)
+
+    def __init__(self, json):
+        self.json = json
+
+    def __repr__(self):
+        return '<RawJSON %r>' % (self.json,)
+
+# placeholder for RawJSON fragments, replaced by the fragments after encoding
+RAW_PLACEHOLDER = u'\x00pareto.jsonexport.raw:%d\x00'
+_raw_placeholder_re = re.compile(r'(\d+)'.join(
+    [re.escape(part) for part in json.dumps(RAW_PLACEHOLDER).split('%d')]))
+
+# serializers from json_serializers per exact class, see get_json_serializer
+_serializers_by_class = {}
+_serializers_registered = []
+
+def get_json_serializer(cls):
+    """ return the function from json_serializers to serialize cls with
+
+        the function is looked up by walking the MRO of cls, so the one
+        registered for the closest base class is used, the result is
+        memoized per class (until json_serializers is changed), returns None
+        if there is no serializer for cls
+    """
+    if _serializers_registered != json_serializers:
+        _serializers_by_class.clear()
+        _serializers_registered[:] = json_serializers
+    try:
+        return _serializers_by_class[cls]
+    except KeyError:
+        pass
+    registered = {}
+    for registered_cls, serializer in reversed(json_serializers):
+        registered[registered_cls] = serializer
+    serializer = None
+    for base in inspect.getmro(cls):
+        serializer = registered.get(base)
+        if serializer is not None:
+            break
+    _serializers_by_class[cls] = serializer
+    return serializer
+
 class JSONEncoder(json.JSONEncoder):
+    def __init__(self, *args, **kwargs):
+        if json.__name__ == 'simplejson':
+            # simplejson, make sure the output equals that of stdlib json
+            kwargs.setdefault('namedtuple_as_object', False)
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+        self.fragments = []
+
     def default(self, obj):
-        for cls, serializer in json_serializers:
-            if isinstance(obj, cls):
-                return serializer(obj)
+        cls = obj.__class__
+        if cls is RawJSON:
+            self.fragments.append(obj.json)
+            return RAW_PLACEHOLDER % (len(self.fragments) - 1,)
+        serializer = get_json_serializer(cls)
+        if serializer is not None:
+            return serializer(obj)
         return json.JSONEncoder.default(self, obj)
 
 def to_json(data):
-    return json.dumps(data, cls=JSONEncoder)
+    encoder = JSONEncoder()
+    ret = encoder.encode(data)
+    if encoder.fragments:
+        fragments = encoder.fragments
+        ret = _raw_placeholder_re.sub(
+            lambda match: fragments[int(match.group(1))], ret)
+    return ret
@@ -0,0 +1,196 @@
+""" offline (parallel) export of a full site
+
+    run using the Zope instance script, e.g.:
+
+      bin/instance run path/to/pareto/jsonexport/offline.py \
+          /plone /var/exports/plone --processes 4
+
+    the children of the root object are divided over a number of shards (by
+    a hash of their id), each shard is exported, by a pool of processes that
+    each have their own database connection, to a JSON Lines file containing
+    the (non-recursive) data of all objects in the shard's subtrees, one
+    object per line, depth-first (see walker.Walker.iter_jsonl), and a file
+    'manifest.json' is written that contains the data of the root object and
+    a description of the shards
+
+    using more than one process requires a ZEO setup, since the processes
+    open their own connection to the database, the shards can be compressed
+    using '--compress gzip' (or 'zstd', if the zstandard package is
+    installed)
+"""
+import os
+import sys
+import zlib
+import optparse
+import multiprocessing
+
+import transaction
+from DateTime import DateTime
+from zope.component.hooks import setSite
+
+# absolute imports, since this module can be run as a script
+from pareto.jsonexport import compression
+from pareto.jsonexport import jsonutils
+from pareto.jsonexport.context import ExportContext, find_site
+from pareto.jsonexport.serializers import get_serializer
+from pareto.jsonexport.walker import Walker
+
+# the state of a worker process, set by _init_worker
+_worker = {}
+
+
+def shard_for(childid, shards):
+    """ return the number of the shard the child with id childid goes into
+    """
+    return (zlib.crc32(childid) & 0xffffffff) % shards
+
+
+def shard_filename(shard, codec=None):
+    return 'shard-%s.jsonl%s' % (
+        shard, compression.EXTENSIONS.get(codec, ''))
+
+
+def export_shard(root, shard, childids, directory, codec=None):
+    """ write the objects below root's children childids to a shard file
+
+        if codec is not None, the file is compressed using that codec (see
+        the compression module), returns a dict describing the shard (for
+        the manifest)
+    """
+    filename = shard_filename(shard, codec)
+    path = os.path.join(directory, filename)
+    serializer = get_serializer(root, ExportContext(root))
+    rootpath = serializer.url(serializer.instance)
+    objects = 0
+    size = 0
+    compressobj = None
+    if codec is not None:
+        compressobj = compression.compressor(codec)
+    fp = open(path + '.tmp', 'wb')
+    try:
+        for childid in childids:
+            walker = serializer.export_context.walker = Walker()
+            for line in walker.iter_jsonl(
+                    serializer.child_serializer(childid), parent=rootpath):
+                if compressobj is not None:
+                    line = compressobj.compress(line)
+                fp.write(line)
+            objects += walker.objects
+            size += walker.bytes
+            # the objects aren't needed anymore, keep the ZODB cache small
+            jar = getattr(root, '_p_jar', None)
+            if jar is not None:
+                jar.cacheMinimize()
+        if compressobj is not None:
+            fp.write(compressobj.flush())
+    finally:
+        fp.close()
+    os.rename(path + '.tmp', path)
+    return {
+        'file': filename,
+        'children': childids,
+        'objects': objects,
+        'bytes': size,
+    }
+
+
+def _init_worker(root_path, directory, codec):
+    """ open a new database connection for a worker process
+    """
+    from App.config import getConfiguration
+    from Testing.makerequest import makerequest
+    dbtab = getConfiguration().dbtab
+    name = dbtab.getName('/')
+    db = dbtab.getDatabaseFactory(name=name).open(name, {})
+    app = makerequest(db.open().root()['Application'])
+    _worker['root'] = root = app.unrestrictedTraverse(root_path)
+    setSite(find_site(root))
+    _worker['directory'] = directory
+    _worker['codec'] = codec
+
+
+def _export_shard(args):
+    shard, childids = args
+    try:
+        return export_shard(
+            _worker['root'], shard, childids, _worker['directory'],
+            _worker['codec'])
+    finally:
+        transaction.abort()
+
+
+def export(root, directory, processes=1, shards=None, codec=None):
+    """ export root and everything below it to directory
+
+        returns the manifest data
+    """
+    if shards is None:
+        shards = processes
+    serializer = get_serializer(root, ExportContext(root))
+    rootdata = serializer.cached_to_dict()
+    childids = {}
+    for childid in rootdata.get('_children') or []:
+        childids.setdefault(shard_for(childid, shards), []).append(childid)
+    tasks = sorted(childids.items())
+    if processes > 1:
+        pool = multiprocessing.Pool(
+            processes, _init_worker,
+            ('/'.join(root.getPhysicalPath()), directory, codec))
+        try:
+            results = pool.map(_export_shard, tasks, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [
+            export_shard(root, shard, ids, directory, codec)
+            for (shard, ids) in tasks]
+    manifest = {
+        'created': DateTime(),
+        'root': rootdata,
+        'objects': sum([result['objects'] for result in results]) + 1,
+        'compression': codec,
+        'shards': results,
+    }
+    fp = open(os.path.join(directory, 'manifest.json'), 'wb')
+    try:
+        fp.write(jsonutils.to_json(manifest))
+    finally:
+        fp.close()
+    return manifest
+
+
+def main(app, argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] <root path> <output directory>')
+    parser.add_option(
+        '-p', '--processes', type='int', default=1,
+        help='number of worker processes (requires ZEO if > 1)')
+    parser.add_option(
+        '-s', '--shards', type='int', default=None,
+        help='number of shards (defaults to the number of processes)')
+    parser.add_option(
+        '-c', '--compress', choices=compression.codecs(), default=None,
+        help='compress the shards (%s)' % (', '.join(compression.codecs()),))
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('expected a root path and an output directory')
+    root_path, directory = args
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    from Testing.makerequest import makerequest
+    root = makerequest(app).unrestrictedTraverse(root_path)
+    # the worker processes set it themselves, see _init_worker
+    setSite(find_site(root))
+    manifest = export(
+        root, directory, processes=options.processes, shards=options.shards,
+        codec=options.compress)
+    print 'exported %s objects in %s shards to %s' % (
+        manifest['objects'], len(manifest['shards']), directory)
+
+
+if __name__ == '__main__':
+    # use the module from the package rather than this script, so the worker
+    # functions can be found by the processes
+    from pareto.jsonexport.offline import main
+    main(app, sys.argv[1:])
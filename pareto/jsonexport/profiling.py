@@ -0,0 +1,62 @@
+""" opt-in timing of the serialization of an export
+
+    an ExportContext with a Profile (see context.ExportContext) makes the
+    serializers record the call counts and cumulative times of:
+
+    * 'to_dict' - the serialization of objects (that were not cached)
+    * 'method' - the serializer_for methods, by key
+    * 'field' - the AT schema fields (including post-processing), by id
+    * 'json' - the encoding of the objects' data, by jsonutils.to_json
+
+    per serializer class, and counts events (e.g. 'serialized' and 'cached'
+    objects, see context.ExportContext.count), without a Profile the
+    serializers only check whether there is one
+"""
+import time
+
+import jsonutils
+
+timer = time.time
+
+
+class Profile(object):
+    """ call counts and cumulative times, and counters
+
+        the timings are keyed on (serializer class, kind, key), the counters
+        on event name
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add(self, cls, kind, key, seconds):
+        timing = self.timings.get((cls, kind, key))
+        if timing is None:
+            self.timings[(cls, kind, key)] = [1, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+
+    def to_list(self, limit=None):
+        """ return a list of dicts with the timings, slowest first
+
+            each dict has the keys 'serializer' (the class name), 'kind',
+            'key', 'calls' and 'seconds'
+        """
+        items = sorted(
+            self.timings.items(), key=lambda item: item[1][1], reverse=True)
+        if limit is not None:
+            items = items[:limit]
+        return [{
+            'serializer': cls.__name__,
+            'kind': kind,
+            'key': key,
+            'calls': calls,
+            'seconds': round(seconds, 6),
+        } for ((cls, kind, key), (calls, seconds)) in items]
+
+    def to_json(self, limit=None):
+        return jsonutils.to_json(self.to_list(limit))
@@ -1,14 +1,25 @@
+import collections
+
+from Missing import MV
 from zope import interface
+from zope.component import getSiteManager
+from ZODB.utils import z64
 from OFS.SimpleItem import Item
-from Products.CMFCore.utils import getToolByName
 
 from Products.Archetypes.Field import ReferenceField
 from Products.Archetypes.Widget import RichWidget
 
 from archetypes.schemaextender.extender import instanceSchemaFactory
+from archetypes.schemaextender.interfaces import ISchemaExtender
+from archetypes.schemaextender.interfaces import ISchemaModifier
 
 import interfaces
 import html
+import cache
+import context
+import profiling
+import jsonutils
+import walker
 
 try:
     from pareto.jsonexport.config import BASE_URL 
@@ -23,6 +34,116 @@ except ImportError:
         'leadimage', 'sidebar', 'summary', 'client'
     ]
 
+
+class Dimensions(collections.Mapping):
+    """ the urls of the DIMENSIONS of an image, as a read-only mapping
+
+        rather than formatting a url per dimension for every image, only
+        the base url is stored and the urls are generated when the mapping
+        is accessed or encoded (to_json() encodes it as a dict)
+    """
+    # (dimension, suffix) pairs, see _templates()
+    _dimension_templates = None
+
+    def __init__(self, url):
+        self.url = url
+
+    @classmethod
+    def _templates(cls):
+        # ('%s_%s' % (url, d)).rstrip('_full') strips characters from the
+        # suffix and, if the suffix is stripped entirely (as for 'full'),
+        # from the url, so the suffixes are stripped once up front and
+        # None marks the case where the url itself should be stripped
+        templates = cls._dimension_templates
+        if templates is None or templates[0] is not DIMENSIONS:
+            templates = cls._dimension_templates = (DIMENSIONS, dict([
+                (d, ('_%s' % (d,)).rstrip('_full') or None)
+                for d in DIMENSIONS]))
+        return templates[1]
+
+    def __getitem__(self, dimension):
+        suffix = self._templates()[dimension]
+        if suffix is None:
+            return self.url.rstrip('_full')
+        return self.url + suffix
+
+    def __iter__(self):
+        return iter(DIMENSIONS)
+
+    def __len__(self):
+        return len(DIMENSIONS)
+
+    def __repr__(self):
+        return '<Dimensions %r>' % (self.url,)
+
+jsonutils.json_serializers.append((Dimensions, dict))
+
+try:
+    from pareto.jsonexport.config import RICH_TEXT_PROCESSORS
+except ImportError:
+    # names of ATSerializer methods to pass rich text values to, see
+    # ATSerializer.rich_text_processors
+    RICH_TEXT_PROCESSORS = ()
+
+# marker returned by post-processors for values that should not be serialized
+SKIP = object()
+
+# field plans of the AT serializers, see ATSerializer.field_plan()
+_field_plans = {}
+
+
+def clear_field_plans(event=None):
+    """ forget all cached field plans
+
+        registered as a handler for component registration events, so
+        the plans are rebuilt when schemaextenders are (un)registered
+    """
+    if event is not None:
+        provided = getattr(event.object, 'provided', None)
+        if (provided is None or not (
+                provided.isOrExtends(ISchemaExtender) or
+                provided.isOrExtends(ISchemaModifier))):
+            return
+    _field_plans.clear()
+
+
+def _hashable(value):
+    # lists and dicts (of hashable values) as tuples, to use in cache keys
+    if isinstance(value, (list, tuple)):
+        return tuple([_hashable(item) for item in value])
+    if isinstance(value, dict):
+        return tuple(sorted([
+            (key, _hashable(item)) for (key, item) in value.items()]))
+    return value
+
+
+def _site_manager_key():
+    # schemaextenders can be registered in the local component registry of
+    # a site, persistent site managers are keyed on their database and oid
+    # so the copies loaded by different connections share the plans
+    sitemanager = getSiteManager()
+    jar = getattr(sitemanager, '_p_jar', None)
+    if jar is None:
+        return id(sitemanager)
+    return (jar.db().database_name, sitemanager._p_oid)
+
+
+def get_serializer(obj, export_context=None):
+    """ return the serializer for obj
+
+        falls back to UnknownTypeSerializer for objects for which there's no
+        serializer registered, if export_context (a context.ExportContext)
+        is passed the serializer will use that
+    """
+    try:
+        serializer = interfaces.ISerializer(obj)
+    except TypeError:
+        serializer = UnknownTypeSerializer(obj)
+    if export_context is not None:
+        serializer.export_context = export_context
+    return serializer
+
+
 # base classes
 def serializer_for(attrId):
     """ decorator to mark methods as serializers for a single field
@@ -48,64 +169,245 @@ class Serializer(object):
     """
     interface.implements(interfaces.ISerializer)
 
-    def __init__(self, instance):
+    # keys of values that depend on other objects than the instance itself,
+    # these are recalculated when the data comes from the cache
+    volatile_keys = ('_children', 'state')
+
+    # memoized physical path and url of the instance, see physical_path()
+    _physical_path = None
+    _url = None
+    # set by child_serializer() to the physical path of the parent
+    _parent_path = None
+    _export_context = None
+
+    def __init__(self, instance, export_context=None):
         self.instance = instance
         if getattr(instance, 'getObject', False):
             self.instance = instance.getObject()
-        self.portal_url = self.instance.portal_url()
+        self._export_context = export_context
+
+    @property
+    def portal_url(self):
+        return self.export_context.portal_url
+
+    def _get_export_context(self):
+        if self._export_context is None:
+            self._export_context = context.ExportContext(self.instance)
+        return self._export_context
+
+    def _set_export_context(self, export_context):
+        self._export_context = export_context
+
+    export_context = property(
+        _get_export_context, _set_export_context,
+        doc=""" the context.ExportContext of the export
+
+            created on first use if none was set, passed on to the
+            serializers of the children
+        """)
+
+    def physical_path(self):
+        """ return the physical path (tuple) of the instance
+
+            memoized, and set by child_serializer() from the path of the
+            parent, so getPhysicalPath() is not called for every object
+        """
+        if self._physical_path is None:
+            self._physical_path = self.instance.getPhysicalPath()
+        return self._physical_path
 
     def clean_path(self, obj):
         return [x for i, x in enumerate(obj.getPhysicalPath()) if i != 1]
 
+    @staticmethod
+    def path_to_url(path):
+        """ return the url for a physical path (tuple, or string)
+        """
+        if isinstance(path, basestring):
+            path = path.split('/')
+        return BASE_URL + '/'.join([x for i, x in enumerate(path) if i != 1])
+
     def clean_url(self, obj):
         return '/'.join(self.clean_path(obj))
 
     def url(self, obj):
+        if obj is self.instance:
+            if self._url is None:
+                self._url = self.path_to_url(self.physical_path())
+            return self._url
         return BASE_URL + self.clean_url(obj)
     
     def dimensionize(self, obj, field_id=''):
         url = self.url(obj)
         if field_id:
-            url = '/'.join([self.url(obj), field_id])
-        return dict([(d, ('%s_%s' % (url, d)).rstrip('_full')) 
-                     for d in DIMENSIONS])
+            url = '%s/%s' % (url, field_id)
+        return Dimensions(url)
+
+    @classmethod
+    def serializer_table(cls):
+        """ return a tuple of (key, function) for the serializer_for methods
+
+            the table is built once per class, the first time the class is
+            used, and stored on the class itself; it is ordered the same as
+            dir() would order the methods, so if two methods serialize the
+            same key the last one wins, and since getattr() is used to find
+            the methods, overrides on subclasses take precedence over the
+            methods of the base classes
+        """
+        table = cls.__dict__.get('_serializer_table')
+        if table is None:
+            table = []
+            for attrName in dir(cls):
+                if attrName.startswith('_'):
+                    continue
+                attr = getattr(cls, attrName)
+                func = getattr(attr, 'im_func', None)
+                if func is None or not hasattr(func, 'serializer_for'):
+                    continue
+                table.append((func.serializer_for, func))
+            table = cls._serializer_table = tuple(table)
+        return table
 
     def to_dict(self, recursive=False):
-        # we find all of our own methods which are decorated using
-        # serializer_for, then we know about the JSON key and know we can call
-        # that method for the JSON value
+        # the methods decorated using serializer_for are collected once per
+        # class (see serializer_table), from that we know about the JSON key
+        # and know we can call that method for the JSON value
         ret = {
             'type': self.instance.meta_type,
             'id': self.instance.getId(),
             'path': self.url(self.instance),
         }
-        for attrName in dir(self):
-            if attrName.startswith('_'):
-                continue
-            attr = getattr(self, attrName)
-            if (not callable(attr) or
-                    not hasattr(attr, 'serializer_for')):
-                continue
-            key = attr.serializer_for
-            value = attr()
-            ret[key] = value
+        export_context = self.export_context
+        table = export_context.project(self.serializer_table())
+        profile = export_context.profile
+        if profile is None:
+            for key, func in table:
+                ret[key] = func(self)
+        else:
+            for key, func in table:
+                start = profiling.timer()
+                ret[key] = func(self)
+                profile.add(
+                    self.__class__, 'method', key, profiling.timer() - start)
         if recursive:
-            # _children is a magic marker for child contents
-            children = ret.get('_children')
-            if children is not None:
-                children_data = []
-                for childid in children:
-                    child = getattr(self.instance, childid)
-                    try:
-                        serializer = interfaces.ISerializer(child)
-                    except TypeError:
-                        children_data.append(
-                            UnknownTypeSerializer(child).to_dict())
-                        continue
-                    children_data.append(serializer.to_dict(recursive=True))
-                ret['_children'] = children_data
+            # _children is a magic marker for child contents, the walker
+            # replaces the ids by the children's data
+            walker.Walker().expand(self, ret)
         return ret
 
+    def cache_key(self):
+        """ return the key to cache the instance's data under
+
+            the key consists of the serializer class, the object's path, the
+            serial of the last transaction that changed the object and the
+            projection of the export, returns None if the data should not
+            be cached (for objects that are not stored in the database (yet)
+            or have been changed in the current transaction, or were never
+            committed)
+        """
+        instance = self.instance
+        if (getattr(instance, '_p_jar', None) is None or
+                instance._p_changed or instance._p_serial == z64):
+            return None
+        return (
+            self.__class__, self.physical_path(), instance._p_serial,
+            self.export_context.projection)
+
+    def cached_to_dict(self):
+        """ return the (non-recursive) dict for the instance, from cache
+
+            data is served from cache.serialized if the object has not
+            changed since it was stored, the values of volatile_keys are
+            always recalculated
+        """
+        key = self.cache_key()
+        if key is None:
+            self.export_context.count('serialized')
+            return self._to_dict()
+        data = cache.serialized.get(key)
+        if data is None:
+            self.export_context.count('serialized')
+            data = self._to_dict()
+            cache.serialized.set(key, data, cache.estimate_size(data))
+            return dict(data)
+        self.export_context.count('cached')
+        data = dict(data)
+        self.refresh(data)
+        return data
+
+    def refresh(self, data):
+        """ recalculate the values of data (cached data of the instance)
+            that depend on other objects than the instance itself
+        """
+        for key, func in self.export_context.project(self.serializer_table()):
+            if key in self.volatile_keys:
+                data[key] = func(self)
+
+    def volatile_items(self, data):
+        """ return the (key, value) pairs of data that refresh() recalculates
+        """
+        return [(key, data.get(key)) for key in self.volatile_keys]
+
+    def _to_dict(self):
+        """ to_dict(), timed if the export is profiled
+        """
+        profile = self.export_context.profile
+        if profile is None:
+            return self.to_dict()
+        start = profiling.timer()
+        ret = self.to_dict()
+        profile.add(self.__class__, 'to_dict', '', profiling.timer() - start)
+        return ret
+
+    def _to_json(self, data):
+        """ jsonutils.to_json(data), timed if the export is profiled
+        """
+        profile = self.export_context.profile
+        if profile is None:
+            return jsonutils.to_json(data)
+        start = profiling.timer()
+        ret = jsonutils.to_json(data)
+        profile.add(self.__class__, 'json', '', profiling.timer() - start)
+        return ret
+
+    def cached_to_json(self, data):
+        """ return the JSON for data (as returned by cached_to_dict)
+
+            the JSON is cached (in cache.serialized) per object and set of
+            recalculated values (see volatile_items()), so for unchanged
+            objects the encoding is done only once
+        """
+        key = self.cache_key()
+        if key is None:
+            return self._to_json(data)
+        key = ('json', key, _hashable(self.volatile_items(data)))
+        try:
+            ret = cache.serialized.get(key)
+        except TypeError:
+            # unhashable volatile values
+            return self._to_json(data)
+        if ret is None:
+            ret = self._to_json(data)
+            cache.serialized.set(key, ret, len(ret))
+        return ret
+
+    def to_fragment(self):
+        """ return a pre-encoded (jsonutils.RawJSON) version of the instance
+
+            can be used as value in the data of other serializers, to_json()
+            inserts the (cached) JSON verbatim
+        """
+        return jsonutils.RawJSON(self.cached_to_json(self.cached_to_dict()))
+
+    def child_serializer(self, childid):
+        """ return the serializer for the child with id childid
+        """
+        serializer = get_serializer(
+            getattr(self.instance, childid), self.export_context)
+        serializer._parent_path = path = self.physical_path()
+        serializer._physical_path = path + (childid,)
+        return serializer
+
     @serializer_for('path')
     def serialize_path(self):
         return self.url(self.instance)
@@ -130,12 +432,51 @@ class SimpleSerializer(Serializer):
 class ReferenceSerializer(SimpleSerializer):
     """ serialize an object as a reference
 
-        used internally for ReferenceFields, etc.
+        used internally for ReferenceFields, etc., from_brain() and
+        from_uids() provide the same data without waking up the objects
     """
     @property
     def type(self):
         return 'Reference'
 
+    @classmethod
+    def from_brain(cls, brain):
+        """ return the reference data for a catalog brain
+        """
+        return {
+            'type': 'Reference',
+            'subtype': brain.meta_type,
+            'path': cls.path_to_url(brain.getPath()),
+            'id': brain.getId,
+        }
+
+    @classmethod
+    def from_uids(cls, export_context, uids):
+        """ return the reference data for the objects with UIDs uids
+
+            all UIDs are resolved using a single catalog query, in the
+            order of uids, objects that are not in the catalog are looked up
+            using the reference catalog (and serialized the normal way),
+            UIDs of objects that no longer exist are skipped, export_context
+            is the context.ExportContext of the export
+        """
+        if not uids:
+            return []
+        catalog = export_context.tool('portal_catalog')
+        brains = dict([
+            (brain.UID, brain)
+            for brain in catalog.unrestrictedSearchResults(UID=list(uids))])
+        ret = []
+        for uid in uids:
+            brain = brains.get(uid)
+            if brain is not None:
+                ret.append(cls.from_brain(brain))
+                continue
+            obj = export_context.tool('reference_catalog').lookupObject(uid)
+            if obj is not None:
+                ret.append(cls(obj, export_context).cached_to_dict())
+        return ret
+
 
 
 class UnknownTypeSerializer(Serializer):
@@ -149,6 +490,78 @@ class UnknownTypeSerializer(Serializer):
         return 'UnknownType'
 
 
+class BrainSerializer(Serializer):
+    """ serialize a catalog brain using the catalog metadata
+
+        the object is only woken up if any of the additional 'fields' is
+        not available as metadata column, in that case its own serializer is
+        used to get those values, since the brains come from unrestricted
+        searches the object is woken up unrestricted as well
+    """
+    # (key, metadata column) pairs
+    metadata = (
+        ('type', 'meta_type'),
+        ('id', 'getId'),
+        ('portal_type', 'portal_type'),
+        ('state', 'review_state'),
+        ('modification_date', 'modified'),
+        ('title', 'Title'),
+        ('description', 'Description'),
+    )
+
+    def __init__(self, brain, fields=(), export_context=None):
+        self.brain = brain
+        self.fields = fields
+        self._export_context = export_context
+
+    @property
+    def instance(self):
+        return self.brain._unrestrictedGetObject()
+
+    def cache_key(self):
+        return None
+
+    def column_value(self, column):
+        """ return the value of metadata column column of the brain
+
+            the catalog stores Missing.Value if there was no value to index
+            (e.g. 'review_state' for objects without workflow), which is
+            returned as None
+        """
+        value = getattr(self.brain, column)
+        if value is MV:
+            return None
+        return value
+
+    def to_dict(self, recursive=False):
+        brain = self.brain
+        ret = {'path': self.path_to_url(brain.getPath())}
+        exclude = ()
+        if self._export_context is not None:
+            exclude = self._export_context.exclude or ()
+        for key, column in self.metadata:
+            if key not in exclude:
+                ret[key] = self.column_value(column)
+        missing = []
+        columns = brain.__record_schema__
+        for field in self.fields:
+            if field in ret or field in exclude:
+                continue
+            if field in columns:
+                ret[field] = self.column_value(field)
+            else:
+                missing.append(field)
+        if missing:
+            # only serialize the missing fields
+            data = get_serializer(
+                self.instance, self.export_context.projected(missing)
+                ).cached_to_dict()
+            for field in missing:
+                if field in data:
+                    ret[field] = data[field]
+        return ret
+
+
 class ATSerializer(Serializer):
     """ base class for ArcheTypes objects
 
@@ -182,51 +595,185 @@ class ATSerializer(Serializer):
 
     @serializer_for('state')
     def serialize_workflow_state(self):
-        wft = getToolByName(self.instance, 'portal_workflow')
-        wfs = wft.getWorkflowsFor(self.instance)
-        assert len(wfs) <= 1, (
+        export_context = self.export_context
+        if self._parent_path is not None:
+            # during a walk, use the catalog metadata of the siblings
+            state = export_context.review_state(
+                self._parent_path, self.instance.getId())
+            if state is not None:
+                return state
+        chain = export_context.workflow_chain(self.instance)
+        assert len(chain) <= 1, (
             'Unexpected error: more than one workflow registered for %s' % (
                 self.instance,))
-        if not wfs:
+        if not chain:
             return None
-        return wft.getStatusOf(wfs[0].id, self.instance)['review_state']
+        return export_context.tool('portal_workflow').getStatusOf(
+            chain[0], self.instance)['review_state']
+
+    # processors that get the raw value of the field rather than the
+    # accessor's, so references can be resolved without loading the objects
+    raw_processors = ('_process_references',)
+
+    # processors of fields whose values depend on other objects, these
+    # fields are recalculated when the data comes from the cache
+    volatile_processors = ('_process_references',)
+
+    # names of methods that are called with (field_id, value) for every rich
+    # text field, before the value is processed, the dicts they return are
+    # added to the serialized data (e.g. 'serialize_rich_text_urls')
+    rich_text_processors = RICH_TEXT_PROCESSORS
 
     def to_dict(self, *args, **kwargs):
         ret = super(ATSerializer, self).to_dict(*args, **kwargs)
-        ret['portal_type'] = portal_type = self.instance.portal_type
+        export_context = self.export_context
+        if export_context.wants('portal_type'):
+            ret['portal_type'] = self.instance.portal_type
+        profile = export_context.profile
+        for field_id, field, processor in export_context.project(
+                self.field_plan()):
+            if profile is not None:
+                start = profiling.timer()
+            value = self._field_value(field, processor)
+            if processor == '_process_rich_text':
+                for name in self.rich_text_processors:
+                    for key, extra in getattr(self, name)(
+                            field_id, value).items():
+                        if export_context.wants(key):
+                            ret[key] = extra
+            if processor is not None:
+                value = getattr(self, processor)(field_id, value)
+            if value is not SKIP:
+                ret[field_id] = value
+            if profile is not None:
+                profile.add(
+                    self.__class__, 'field', field_id,
+                    profiling.timer() - start)
+        return ret
+
+    def _field_value(self, field, processor):
+        if processor in self.raw_processors:
+            return field.getRaw(self.instance)
+        return field.getAccessor(self.instance)()
+
+    def volatile_fields(self):
+        """ return the entries of the (projected) field plan of the fields
+            that refresh() recalculates
+        """
+        return [
+            (field_id, field, processor)
+            for (field_id, field, processor) in self.export_context.project(
+                self.field_plan())
+            if processor in self.volatile_processors]
+
+    def refresh(self, data):
+        super(ATSerializer, self).refresh(data)
+        for field_id, field, processor in self.volatile_fields():
+            value = getattr(self, processor)(
+                field_id, self._field_value(field, processor))
+            if value is SKIP:
+                data.pop(field_id, None)
+            else:
+                data[field_id] = value
+
+    def volatile_items(self, data):
+        return super(ATSerializer, self).volatile_items(data) + [
+            (field_id, data.get(field_id))
+            for (field_id, field, processor) in self.volatile_fields()]
+
+    def field_plan(self):
+        """ return the field plan for the instance
+
+            a field plan is an ordered list of (field_id, field, processor)
+            tuples, where processor is the name of the method to post-process
+            the value with (or None), the plan is cached per serializer
+            class, portal type, set of provided interfaces and site manager
+            (which together determine what schemaextenders apply), and is
+            built by looking at the schema only once for all instances that
+            share those
+
+            schemaextenders whose fields depend on the instance itself
+            (rather than on its type and interfaces) are not supported
+        """
+        key = (
+            self.__class__, self.instance.portal_type,
+            interface.providedBy(self.instance),
+            interface.providedBy(getattr(self.instance, 'REQUEST', None)),
+            _site_manager_key())
+        plan = _field_plans.get(key)
+        if plan is None:
+            plan = _field_plans[key] = self._build_field_plan()
+        return plan
+
+    def _build_field_plan(self):
+        plan = []
         schema = instanceSchemaFactory(self.instance)
         for field_id in schema.keys():
             if field_id in self.skip_fields:
                 continue
             field = schema[field_id]
-            _schema = schema
-            if field_id in self.instance.schema:
-                _schema = self.instance.schema
-            value = self._get_from_schema(field_id, _schema)
             if isinstance(field, ReferenceField):
-                value = [
-                    ReferenceSerializer(item).to_dict() for item in value]
+                processor = '_process_references'
             elif isinstance(field.widget, RichWidget):
-                value = self.rich_text(value)
-            elif isinstance(value, Item):
-                serializer = interfaces.ISerializer(value)
-                value = serializer.to_dict(recursive=True)
-            elif field_id == 'image' and self.instance.portal_type == 'Image':
-                continue
+                processor = '_process_rich_text'
+            elif (field_id == 'image' and
+                    self.instance.portal_type == 'Image'):
+                processor = '_process_image'
             elif field_id == 'leadImage':
-                if value:
-                    value = {
-                        'dimensions': self.dimensionize(value, field_id),
-                        'width': value.width,
-                        'height': value.height,
-                    }
-                else:
-                    value = ""
-            elif hasattr(value, 'blob'):
-                # file or image content, ignore
-                continue
-            ret[field_id] = value
-        return ret
+                processor = '_process_lead_image'
+            else:
+                processor = '_process_value'
+            plan.append((field_id, field, processor))
+        return tuple(plan)
+
+    def _process_references(self, field_id, value):
+        # value is a UID, or a list of UIDs for multi-valued fields
+        if not value:
+            return []
+        if isinstance(value, basestring):
+            value = [value]
+        return ReferenceSerializer.from_uids(self.export_context, value)
+
+    def serialize_rich_text_urls(self, field_id, value):
+        """ rich text processor that adds the urls of the links and media
+            in the field's value as '<field_id>_urls' (see
+            html.urls_from_html)
+        """
+        return {'%s_urls' % (field_id,): html.urls_from_html(value or '')}
+
+    def _process_rich_text(self, field_id, value):
+        return self.rich_text(value)
+
+    def _process_value(self, field_id, value):
+        if isinstance(value, Item):
+            serializer = interfaces.ISerializer(value)
+            export_context = self.export_context
+            if export_context.projection is not None:
+                # the projection selects the values of the instance, the
+                # value is serialized completely
+                export_context = export_context.projected()
+            serializer.export_context = export_context
+            return serializer.to_dict(recursive=True)
+        elif hasattr(value, 'blob'):
+            # file or image content, ignore
+            return SKIP
+        return value
+
+    def _process_image(self, field_id, value):
+        if isinstance(value, Item):
+            return self._process_value(field_id, value)
+        return SKIP
+
+    def _process_lead_image(self, field_id, value):
+        if isinstance(value, Item):
+            return self._process_value(field_id, value)
+        if not value:
+            return ""
+        return {
+            'dimensions': self.dimensionize(value, field_id),
+            'width': value.width,
+            'height': value.height,
+        }
 
     def _get_from_schema(self, id, schema):
         return self.instance.getField(id).getAccessor(self.instance)()
@@ -268,10 +815,14 @@ class ATFolderSerializer(ATSerializer):
 
 
 class CollectionSerializer(ATSerializer):
+    # the results change when other objects do
+    volatile_keys = ATSerializer.volatile_keys + ('results',)
+
     @serializer_for('results')
     def serialize_items(self):
-        items = self.instance.results(batch=False)
-        return [ReferenceSerializer(item).to_dict() for item in items]
+        # brains, so the results don't have to be woken up
+        brains = self.instance.results(batch=False, brains=True)
+        return [ReferenceSerializer.from_brain(brain) for brain in brains]
 
 
 class ImageSerializer(ItemSerializer):
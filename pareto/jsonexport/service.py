@@ -5,13 +5,147 @@ import time
 import urllib2
 import socket
 import base64
+import itertools
 
-from zope import lifecycleevent
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from Acquisition import aq_base
+from ZPublisher.BaseRequest import RequestContainer
+from zope.annotation.interfaces import IAnnotations
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
 
 from interfaces import ISerializer
+from serializers import BrainSerializer, Serializer, get_serializer
+from context import ExportContext
+from walker import Walker
+from dump import dump
 
 import jsonutils
 
+try:
+    from pareto.jsonexport.config import TOMBSTONE_DAYS
+except ImportError:
+    TOMBSTONE_DAYS = 90
+
+TOMBSTONES_KEY = 'pareto.jsonexport.tombstones'
+
+
+def record_tombstone(obj, event):
+    """ register the old path of a removed (or moved) object
+
+        registered as subscriber for IObjectMovedEvent, the tombstones are
+        stored (in an OOBTree with (timestamp, path) keys and the new path
+        of moved objects, or None for removed ones, as values) in an
+        annotation on the portal, and are used to report deleted and moved
+        objects in delta exports, tombstones older than TOMBSTONE_DAYS are
+        removed
+
+        only the path of the object the event is about is stored, not those
+        of its children
+    """
+    if obj is not event.object or event.oldParent is None:
+        return
+    try:
+        portal = getToolByName(event.oldParent, 'portal_url').getPortalObject()
+    except AttributeError:
+        # not inside a portal, or the portal itself is removed
+        return
+    annotations = IAnnotations(portal)
+    tombstones = annotations.get(TOMBSTONES_KEY)
+    if tombstones is None:
+        tombstones = annotations[TOMBSTONES_KEY] = OOBTree()
+    now = time.time()
+    for key in list(tombstones.keys(max=(now - TOMBSTONE_DAYS * 86400,))):
+        del tombstones[key]
+    path = '/'.join(event.oldParent.getPhysicalPath() + (event.oldName,))
+    newpath = None
+    if event.newParent is not None:
+        newpath = '/'.join(
+            event.newParent.getPhysicalPath() + (event.newName,))
+    tombstones[(now, path)] = newpath
+
+
+def get_tombstones(portal, since, path=''):
+    """ return the paths of the objects removed since timestamp since
+
+        the paths are physical paths (as strings), only those below path
+        are returned
+    """
+    tombstones = IAnnotations(portal).get(TOMBSTONES_KEY)
+    if tombstones is None:
+        return []
+    ret = []
+    seen = set()
+    for timestamp, tombstone in tombstones.keys(min=(since,)):
+        if tombstone in seen:
+            continue
+        seen.add(tombstone)
+        if is_below(tombstone, path):
+            ret.append(tombstone)
+    return ret
+
+
+def get_moves(portal, since, path=''):
+    """ return (old path, new path) for the objects moved since since
+
+        in the order in which they were moved, only moves from or to below
+        path are returned
+    """
+    tombstones = IAnnotations(portal).get(TOMBSTONES_KEY)
+    if tombstones is None:
+        return []
+    ret = []
+    for (timestamp, tombstone), newpath in tombstones.items(min=(since,)):
+        if newpath is None:
+            continue
+        if is_below(tombstone, path) or is_below(newpath, path):
+            ret.append((tombstone, newpath))
+    return ret
+
+
+def newest_tombstone(portal, since, path=''):
+    """ return the timestamp of the newest tombstone below path
+
+        only tombstones newer than timestamp since are looked at, returns
+        None if there are none
+    """
+    tombstones = IAnnotations(portal).get(TOMBSTONES_KEY)
+    if tombstones is None:
+        return None
+    ret = None
+    for timestamp, tombstone in tombstones.keys(min=(since,)):
+        if is_below(tombstone, path):
+            ret = timestamp
+    return ret
+
+
+def is_below(path, root):
+    """ return True if path is root or a path below it
+    """
+    return path == root or path.startswith(root + '/')
+
+
+def catalog_rids(catalog, path):
+    """ generate the record ids of the objects at and below path in catalog
+
+        sorted on path: the catalog's mapping of paths to record ids is
+        sorted already, so this doesn't search (nor create brains), and
+        since it doesn't filter on permissions or expiration, inactive
+        objects and objects the user can't view are included
+    """
+    rid = catalog.getrid(path)
+    if rid is not None:
+        yield rid
+    # ids can't contain '\xff', so this is everything that starts with path
+    for rid in catalog._catalog.uids.values(
+            min=path + '/', max=path + '/\xff'):
+        yield rid
+
 
 class service(object):
     """ provide the core services, serialization and HTTP interaction
@@ -20,11 +154,271 @@ class service(object):
         components come together
     """
     @classmethod
-    def render(cls, instance, recursive=False):
+    def render(
+            cls, instance, recursive=False, walker=None, profile=None,
+            dedicated=False, fields=None, exclude=None):
+        return ''.join(dump(cls.render_iter(
+            instance, recursive=recursive, walker=walker, profile=profile,
+            dedicated=dedicated, fields=fields, exclude=exclude)))
+
+    @classmethod
+    def render_iter(
+            cls, instance, recursive=False, walker=None, profile=None,
+            dedicated=False, fields=None, exclude=None):
+        """ generate the JSON for instance in chunks
+
+            the tree is walked by walker (a walker.Walker, which can be used
+            to limit the amount of work), in recursive mode each child's
+            JSON is generated as soon as the child is serialized, so only
+            the objects on the path to the current object are kept in memory,
+            if profile (a profiling.Profile) is passed the serialization is
+            timed, if dedicated is true the objects are loaded using a
+            separate database connection (see open_dedicated), fields and
+            exclude limit the values that are serialized (see
+            context.ExportContext)
+        """
+        if walker is None:
+            walker = Walker()
+        close = None
+        if dedicated:
+            instance, close = cls.open_dedicated(instance)
+        chunks = walker.iter_json(
+            cls.serializer(instance, ExportContext(
+                instance, walker, profile=profile, fields=fields,
+                exclude=exclude)),
+            recursive)
+        return cls._closing(chunks, close)
+
+    @classmethod
+    def render_jsonl_iter(
+            cls, instance, recursive=False, walker=None, profile=None,
+            dedicated=False, fields=None, exclude=None):
+        """ generate the JSON Lines for instance, one object per line
+
+            see walker.Walker.iter_jsonl
+        """
+        if walker is None:
+            walker = Walker()
+        close = None
+        if dedicated:
+            instance, close = cls.open_dedicated(instance)
+        chunks = walker.iter_jsonl(
+            cls.serializer(instance, ExportContext(
+                instance, walker, profile=profile, fields=fields,
+                exclude=exclude)),
+            recursive)
+        return cls._closing(chunks, close)
+
+    @classmethod
+    def validators(cls, instance, recursive=False):
+        """ return (last modified, token) for the export of instance
+
+            this doesn't serialize anything: last modified is a timestamp,
+            the newest of the object's last change, the modification dates
+            (from the catalog) of its children, or of everything below it in
+            recursive mode, and the last removal or move below it, the token
+            (a string) changes whenever the export may have changed, since
+            it also contains the amount of catalogued objects and, if the
+            catalog keeps one, its change counter
+
+            changes to objects that are not catalogued (other than instance
+            itself) are not noticed, and changes that don't update the
+            modification date (e.g. workflow transitions of children) only
+            change the token, not last modified
+        """
+        path = '/'.join(instance.getPhysicalPath())
+        last_modified = getattr(aq_base(instance), '_p_mtime', None) or 0
+        parts = [path, recursive]
+        catalog = getToolByName(instance, 'portal_catalog', None)
+        if catalog is not None:
+            query = {'query': path}
+            if not recursive:
+                query['depth'] = 1
+            parts.append(len(catalog.unrestrictedSearchResults(path=query)))
+            newest = catalog.unrestrictedSearchResults(
+                path=query, sort_on='modified', sort_order='reverse',
+                sort_limit=1)[:1]
+            if newest:
+                modified = getattr(newest[0].modified, 'timeTime', None)
+                if modified is not None:
+                    last_modified = max(last_modified, modified())
+            counter = getattr(aq_base(catalog), 'getCounter', None)
+            if counter is not None:
+                parts.append(catalog.getCounter())
+        portal_url = getToolByName(instance, 'portal_url', None)
+        if portal_url is not None:
+            removed = newest_tombstone(
+                portal_url.getPortalObject(), last_modified, path)
+            if removed is not None:
+                last_modified = max(last_modified, removed)
+        parts.append(last_modified)
+        return last_modified, md5(repr(parts)).hexdigest()
+
+    @staticmethod
+    def open_dedicated(instance):
+        """ return instance from a new database connection, and a function
+            to close that connection
+
+            big exports load many objects, using a connection of their own
+            keeps them out of the cache of the connection the request uses
+            (which is shared with the rest of the site's traffic), the
+            cache of the dedicated connection is emptied when it's closed
+        """
+        connection = aq_base(instance)._p_jar.db().open()
+        app = connection.root()['Application']
+        request = getattr(instance, 'REQUEST', None)
+        if request is not None:
+            app = app.__of__(RequestContainer(REQUEST=request))
+        instance = app.unrestrictedTraverse(instance.getPhysicalPath())
+
+        def close():
+            connection.cacheMinimize()
+            connection.close()
+        return instance, close
+
+    @staticmethod
+    def _closing(chunks, close):
+        """ generate chunks, call close (if not None) when done
+        """
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if close is not None:
+                close()
+
+    @staticmethod
+    def serializer(instance, export_context):
+        """ return the ISerializer for the root object of an export
+        """
         serializer = ISerializer(instance)
-        data = serializer.to_dict(recursive=recursive)
-        _json = jsonutils.to_json(data)
-        import pprint, json
-        open('/tmp/json', 'w').write(_json)
-        open('/tmp/json_pretty', 'w').write(pprint.pformat(json.loads(_json)))
-        return _json
+        serializer.export_context = export_context
+        return serializer
+
+    @classmethod
+    def render_brains_iter(
+            cls, instance, fields=(), batch_size=1000, exclude=None):
+        """ generate a JSON list of all catalogued objects below instance
+
+            the objects are serialized from the catalog brains (see
+            serializers.BrainSerializer), sorted on path, and the JSON is
+            generated per batch of batch_size objects, fields are the
+            values to serialize in addition to the catalog metadata, values
+            with keys in exclude are left out
+        """
+        export_context = ExportContext(instance, exclude=exclude)
+        catalog = export_context.tool('portal_catalog')
+        rids = catalog_rids(catalog, '/'.join(instance.getPhysicalPath()))
+        yield '['
+        first = True
+        while True:
+            # the brains (and metadata records) are only created per batch
+            brains = [
+                catalog._catalog[rid]
+                for rid in itertools.islice(rids, batch_size)]
+            if not brains:
+                break
+            chunk = ', '.join([
+                jsonutils.to_json(BrainSerializer(
+                    brain, fields, export_context).to_dict())
+                for brain in brains])
+            if not first:
+                chunk = ', ' + chunk
+            first = False
+            yield chunk
+        yield ']'
+
+    @classmethod
+    def render_delta(cls, instance, since, fields=None, exclude=None):
+        """ return a JSON delta document of the changes below instance
+
+            since is a DateTime, the delta document is a dict with keys:
+
+            * since - the timestamp the delta starts
+            * until - the timestamp to pass as 'since' for the next delta
+            * modified - list of serialized objects modified after 'since',
+              including those (and their children) moved to their current
+              location after 'since', sorted on path
+            * deleted - list of paths of objects (and their children)
+              removed or moved away after 'since'
+            * moved - list of dicts with the 'from' and 'to' paths of the
+              objects moved after 'since', in order
+
+            since objects can be removed and re-created in the same period,
+            deletions should be processed before modifications, fields and
+            exclude limit the values of the modified objects
+        """
+        until = DateTime()
+        export_context = ExportContext(
+            instance, fields=fields, exclude=exclude)
+        path = '/'.join(instance.getPhysicalPath())
+        catalog = export_context.tool('portal_catalog')
+        portal = export_context.tool('portal_url').getPortalObject()
+        moves = get_moves(portal, since.timeTime(), path)
+        # unrestricted, so expired objects (and objects the user can't view
+        # in the listings) aren't left out
+        brains = {}
+        for brain in catalog.unrestrictedSearchResults(
+                path=path, modified={'query': since, 'range': 'min'}):
+            brains[brain.getPath()] = brain
+        # moving doesn't change the modification date
+        for oldpath, newpath in moves:
+            if is_below(newpath, path):
+                for brain in catalog.unrestrictedSearchResults(path=newpath):
+                    brains[brain.getPath()] = brain
+        data = {
+            'since': since,
+            'until': until,
+            'modified': [
+                get_serializer(
+                    brains[brainpath]._unrestrictedGetObject(),
+                    export_context).to_fragment()
+                for brainpath in sorted(brains)],
+            'deleted': [
+                Serializer.path_to_url(tombstone) for tombstone in
+                get_tombstones(portal, since.timeTime(), path)],
+            'moved': [
+                {'from': Serializer.path_to_url(oldpath),
+                    'to': Serializer.path_to_url(newpath)}
+                for oldpath, newpath in moves],
+        }
+        return jsonutils.to_json(data)
+
+    @classmethod
+    def stream(
+            cls, instance, write, recursive=False, walker=None,
+            bufsize=64 * 1024, profile=None, dedicated=False, fields=None,
+            exclude=None):
+        """ write the JSON for instance to callable write
+        """
+        if walker is None:
+            walker = Walker()
+        close = None
+        if dedicated:
+            instance, close = cls.open_dedicated(instance)
+        export_context = ExportContext(
+            instance, walker, profile=profile, fields=fields, exclude=exclude)
+        cls.write(
+            dump(cls._closing(walker.iter_json(
+                cls.serializer(instance, export_context), recursive), close)),
+            write, bufsize=bufsize)
+
+    @staticmethod
+    def write(chunks, write, bufsize=64 * 1024):
+        """ write the strings from iterable chunks to callable write
+
+            chunks are buffered until at least bufsize bytes are available,
+            to avoid calling write (e.g. RESPONSE.write) for every small
+            chunk
+        """
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= bufsize:
+                write(''.join(buffer))
+                buffer = []
+                size = 0
+        if buffer:
+            write(''.join(buffer))
@@ -0,0 +1,244 @@
+""" micro-benchmarks for the serialization pipeline
+
+    these are not part of the test suite, run them from an environment that
+    has Zope on the path (e.g. 'bin/zopepy' or 'bin/instance run') using:
+
+      python -m pareto.jsonexport.tests.benchmarks
+"""
+import sys
+import timeit
+import datetime
+
+import BeautifulSoup
+from DateTime import DateTime
+
+from .. import compression
+from .. import html
+from .. import jsonutils
+from .. import serializers
+from ..serializers import serializer_for
+
+
+class DummyObject(object):
+    meta_type = 'Dummy'
+    id = 'dummy'
+    title = 'Dummy'
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def portal_url(self):
+        return 'http://nohost/plone'
+
+    def getId(self):
+        return self.id
+
+    def getPhysicalPath(self):
+        return ('', 'plone', 'folder', self.id)
+
+    def objectIds(self):
+        return []
+
+
+class DummySerializer(serializers.FolderSerializer):
+    """ serializer with a realistic amount of marked methods
+    """
+    @serializer_for('a')
+    def serialize_a(self):
+        return 'a'
+
+    @serializer_for('b')
+    def serialize_b(self):
+        return 'b'
+
+    @serializer_for('c')
+    def serialize_c(self):
+        return 'c'
+
+
+def dir_scan_to_dict(serializer):
+    """ the pre-0.2 implementation of Serializer.to_dict, for comparison
+    """
+    ret = {
+        'type': serializer.instance.meta_type,
+        'id': serializer.instance.getId(),
+        'path': serializer.url(serializer.instance),
+    }
+    for attrName in dir(serializer):
+        if attrName.startswith('_'):
+            continue
+        attr = getattr(serializer, attrName)
+        if (not callable(attr) or
+                not hasattr(attr, 'serializer_for')):
+            continue
+        ret[attr.serializer_for] = attr()
+    return ret
+
+
+def bench_method_table(number=20000):
+    """ per-object overhead of finding the serializer_for methods
+    """
+    serializer = DummySerializer(DummyObject())
+    before = timeit.timeit(
+        lambda: dir_scan_to_dict(serializer), number=number)
+    after = timeit.timeit(serializer.to_dict, number=number)
+    return [
+        ('dir() scan', before / number),
+        ('method table', after / number),
+    ]
+
+
+class IsinstanceChainEncoder(jsonutils.json.JSONEncoder):
+    """ the pre-0.2 implementation of jsonutils.JSONEncoder, for comparison
+    """
+    def default(self, obj):
+        for cls, serializer in jsonutils.json_serializers:
+            if isinstance(obj, cls):
+                return serializer(obj)
+        return jsonutils.json.JSONEncoder.default(self, obj)
+
+
+def export_payload(items=1000):
+    """ return data resembling a recursive export of a folder of news items
+    """
+    now = DateTime()
+    today = datetime.date.today()
+    children = []
+    for i in range(items):
+        children.append({
+            'type': 'ATNewsItem',
+            'portal_type': 'News Item',
+            'id': 'item%s' % (i,),
+            'path': '/plone/news/item%s' % (i,),
+            'title': 'News item %s' % (i,),
+            'description': 'Description of news item %s.' % (i,),
+            'text': '<p>Some text.</p>' * 50,
+            'subject': ('foo', 'bar'),
+            'creation_date': now,
+            'modification_date': now,
+            'effectiveDate': today,
+            'expirationDate': None,
+            'language': 'en',
+            'location': '',
+            'creators': ('admin',),
+            'contributors': (),
+            'rights': '',
+            'state': 'published',
+            'relatedItems': [
+                {'type': 'Reference', 'subtype': 'ATDocument',
+                    'path': '/plone/doc%s' % (j,), 'id': 'doc%s' % (j,)}
+                for j in range(3)],
+        })
+    return {'type': 'ATFolder', 'id': 'news', '_children': children}
+
+
+def bench_to_json(number=5):
+    """ encoding time of an export payload, per object
+    """
+    data = export_payload()
+    objects = len(data['_children'])
+    before = timeit.timeit(
+        lambda: jsonutils.json.dumps(data, cls=IsinstanceChainEncoder),
+        number=number)
+    after = timeit.timeit(lambda: jsonutils.to_json(data), number=number)
+    return [
+        ('isinstance chain', before / number / objects),
+        ('dispatch (%s)' % (jsonutils.json.__name__,),
+            after / number / objects),
+    ]
+
+
+def bench_compression(number=3, chunksize=64 * 1024):
+    """ compressed size and CPU cost per codec and level
+    """
+    data = jsonutils.to_json(export_payload())
+    chunks = [
+        data[i:i + chunksize] for i in xrange(0, len(data), chunksize)]
+    megabytes = len(data) / (1024.0 * 1024)
+    results = []
+    for codec in compression.codecs():
+        for level in sorted(set([1, compression.COMPRESSION_LEVELS[codec]])):
+            compressed = ''.join(
+                compression.compress_iter(chunks, codec, level))
+            seconds = timeit.timeit(
+                lambda: list(compression.compress_iter(chunks, codec, level)),
+                number=number) / number
+            results.append(
+                ('%s -%s' % (codec, level), len(compressed),
+                    len(compressed) / float(len(data)), seconds / megabytes))
+    return len(data), results
+
+
+def reparse_html_to_text(markup):
+    """ the pre-0.2 implementation of html.html_to_text, for comparison
+
+        re-parses the contents of every element, so it is quadratic in the
+        depth of the document
+    """
+    soup = BeautifulSoup.BeautifulSoup(markup)
+    ret = []
+    for tag in soup.contents:
+        if isinstance(tag, basestring):
+            ret.append(tag)
+            continue
+        name = tag.name.lower()
+        content = reparse_html_to_text(
+            u''.join(unicode(c) for c in tag.contents))
+        formatter = html.FORMATTERS.get(name)
+        if formatter is not None:
+            ret.append(formatter(tag, content))
+        else:
+            ret.append(content)
+            if name in html.BLOCKELS:
+                ret.append('\n')
+    return ''.join(ret)
+
+
+def rich_text_body(paragraphs, depth):
+    """ return html of paragraphs nested depth levels deep
+    """
+    paragraph = (
+        '<p>Some <a href="http://example.com/">text</a> with <b>markup</b>'
+        '</p><ul><li>one</li><li>two</li></ul>')
+    return '<div>' * depth + paragraph * paragraphs + '</div>' * depth
+
+
+def bench_html_to_text(number=3):
+    """ conversion time per element, for bodies of increasing depth
+    """
+    results = []
+    for depth in (1, 10, 40):
+        markup = rich_text_body(50, depth)
+        elements = 50 * 7 + depth
+        for label, func in (
+                ('re-parse', reparse_html_to_text),
+                ('single pass', html.html_to_text)):
+            seconds = timeit.timeit(lambda: func(markup), number=number)
+            results.append((
+                '%s, depth %s' % (label, depth),
+                seconds / number / elements))
+    return results
+
+
+def report_compression(size, results, out=sys.stdout):
+    out.write('compression (%s bytes of JSON)\n' % (size,))
+    for label, compressed, ratio, seconds in results:
+        out.write('  %-20s %10s bytes (%5.1f%%) %8.2f msec/MB\n' % (
+            label, compressed, ratio * 100, seconds * 1000))
+
+
+def report(name, results, out=sys.stdout):
+    out.write('%s\n' % (name,))
+    for label, seconds in results:
+        out.write('  %-20s %8.2f usec/object\n' % (label, seconds * 1e6))
+
+
+def main():
+    report('Serializer.to_dict', bench_method_table())
+    report('jsonutils.to_json', bench_to_json())
+    report_compression(*bench_compression())
+    report('html.html_to_text', bench_html_to_text())
+
+
+if __name__ == '__main__':
+    main()
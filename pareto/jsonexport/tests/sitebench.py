@@ -0,0 +1,256 @@
+""" benchmarks of the export pipeline on a synthetic site
+
+    these are not part of the test suite (the module name doesn't match the
+    test file pattern), run them using the test runner:
+
+      bin/test -s pareto.jsonexport --test-file-pattern=sitebench
+
+    the site consists of BENCHMARK_FOLDERS folders (environment variable,
+    10 by default) that each contain BENCHMARK_ITEMS documents and news
+    items (50 by default), with rich text and references, and a collection,
+    for every part of the pipeline the objects per second, the bytes
+    produced and the growth of the RSS of the process during the benchmark
+    (sampled, so only on platforms with /proc/self/statm) are reported
+
+    the results are compared to those in BENCHMARK_BASELINE (by default
+    'sitebench-baseline.json' next to this module), a benchmark fails if its
+    objects per second drop more than BENCHMARK_TOLERANCE (a fraction, 0.25
+    by default) below the baseline, if the baseline has no results for the
+    site size the test fails, set BENCHMARK_SAVE to store the results as the
+    new baseline instead
+"""
+import os
+import sys
+import time
+import threading
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from Products.CMFPlone.utils import _createObjectByType
+from Products.CMFCore.utils import getToolByName
+
+from .. import cache
+from .. import html
+from .. import jsonutils
+from ..interfaces import ISerializer
+from ..service import service
+from .tests import SerializersLayer
+
+FOLDERS = int(os.environ.get('BENCHMARK_FOLDERS', 10))
+ITEMS = int(os.environ.get('BENCHMARK_ITEMS', 50))
+BASELINE = os.environ.get(
+    'BENCHMARK_BASELINE',
+    os.path.join(os.path.dirname(__file__), 'sitebench-baseline.json'))
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.25))
+
+RICH_TEXT = '''\
+<div class="section"><h2>Item %(id)s</h2>
+<p>Some text with <a href="http://example.com/%(id)s">a link</a>,
+<strong>bold</strong> and <em>emphasized</em> words.</p>
+<div><div><ul><li>one</li><li>two <a href="../other">other</a></li></ul>
+<p><img src="image-%(id)s.png" alt="" /></p></div></div>
+<table><tr><td>a</td><td>b</td></tr><tr><td>c</td><td>d</td></tr></table>
+</div>'''
+
+
+def build_site(portal, folders=FOLDERS, items=ITEMS):
+    """ create the synthetic site in a folder 'benchmark' in portal
+
+        every item references the previous one, every folder contains a
+        collection of all news items
+    """
+    wft = getToolByName(portal, 'portal_workflow')
+    wft.setChainForPortalTypes(['Folder'], 'folder_workflow')
+    wft.setChainForPortalTypes(
+        ['Document', 'News Item'], 'simple_publication_workflow')
+    _createObjectByType('Folder', portal, id='benchmark', title='Benchmark')
+    root = portal.benchmark
+    previous = None
+    for i in range(folders):
+        folderid = 'folder%s' % (i,)
+        _createObjectByType('Folder', root, id=folderid, title=folderid)
+        folder = getattr(root, folderid)
+        for j in range(items):
+            itemid = 'item%s' % (j,)
+            portal_type = j % 2 and 'News Item' or 'Document'
+            _createObjectByType(portal_type, folder, id=itemid, title=itemid)
+            item = getattr(folder, itemid)
+            item.setDescription('Description of %s.' % (itemid,))
+            item.setText(RICH_TEXT * 5 % {'id': '%s-%s' % (i, j)})
+            if previous is not None:
+                item.setRelatedItems([previous])
+            if j % 3 == 0:
+                wft.doActionFor(item, 'publish')
+            item.reindexObject()
+            previous = item
+        _createObjectByType(
+            'Collection', folder, id='collection', title='News')
+        folder.collection.setQuery(
+            [{'i': 'portal_type',
+                'o': 'plone.app.querystring.operation.selection.is',
+                'v': ['News Item']}])
+    return root
+
+
+class SiteBenchmarkLayer(SerializersLayer):
+    def setUpPloneSite(self, portal):
+        build_site(portal)
+
+
+SITE_BENCHMARK = SiteBenchmarkLayer()
+
+
+def current_rss():
+    """ return the RSS of the process in bytes, None if it's unknown
+    """
+    try:
+        fp = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        fp.close()
+
+
+class RSSSampler(threading.Thread):
+    """ samples the RSS of the process until stop() is called
+
+        'peak' is the highest RSS seen, the process' lifetime peak
+        (ru_maxrss) can't be used since it doesn't go down between
+        benchmarks
+    """
+    def __init__(self, interval=0.01):
+        super(RSSSampler, self).__init__()
+        self.setDaemon(True)
+        self.interval = interval
+        self.start_rss = self.peak = current_rss()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.isSet():
+            self.peak = max(self.peak, current_rss())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak - self.start_rss
+
+
+def measure(func, objects):
+    """ call func, return a dict with the results
+
+        func should return the amount of bytes it produced, 'rss_growth' is
+        the peak RSS during the call minus the RSS before it (in bytes), or
+        None if the RSS can't be determined
+    """
+    sampler = None
+    if current_rss() is not None:
+        sampler = RSSSampler()
+        sampler.start()
+    rss_growth = None
+    start = time.time()
+    try:
+        size = func()
+    finally:
+        seconds = time.time() - start
+        if sampler is not None:
+            rss_growth = sampler.stop()
+    return {
+        'objects': objects,
+        'seconds': seconds,
+        'objects_per_second': objects / max(seconds, 1e-6),
+        'bytes': size,
+        'rss_growth': rss_growth,
+    }
+
+
+def run_benchmarks(root):
+    """ run all benchmarks on the objects below root
+    """
+    catalog = getToolByName(root, 'portal_catalog')
+    brains = catalog.unrestrictedSearchResults(
+        path='/'.join(root.getPhysicalPath()))
+    objects = [brain.getObject() for brain in brains]
+    results = {}
+    dicts = []
+
+    def to_dict():
+        for obj in objects:
+            dicts.append(ISerializer(obj).to_dict())
+        return sum([cache.estimate_size(data) for data in dicts])
+
+    def to_json():
+        return sum([len(jsonutils.to_json(data)) for data in dicts])
+
+    def html_to_text():
+        return sum([
+            len(html.html_to_text(obj.getText())) for obj in objects
+            if getattr(obj.aq_base, 'getText', None) is not None])
+
+    def render():
+        return len(service.render(root, recursive=True))
+
+    cache.serialized.clear()
+    results['ISerializer.to_dict'] = measure(to_dict, len(objects))
+    results['jsonutils.to_json'] = measure(to_json, len(objects))
+    results['html.html_to_text'] = measure(html_to_text, len(objects))
+    cache.serialized.clear()
+    results['service.render (cold)'] = measure(render, len(objects))
+    results['service.render (warm)'] = measure(render, len(objects))
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('\nsite of %s folders x %s items\n' % (FOLDERS, ITEMS))
+    for name, result in sorted(results.items()):
+        out.write('  %-24s %10.1f objects/s %12s bytes %12s RSS growth\n' % (
+            name, result['objects_per_second'], result['bytes'],
+            result['rss_growth']))
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """ return the names of the benchmarks that are slower than baseline
+    """
+    ret = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if (result['objects_per_second'] <
+                expected['objects_per_second'] * (1 - tolerance)):
+            ret.append(name)
+    return ret
+
+
+class SiteBenchmarkTestCase(unittest.TestCase):
+    layer = SITE_BENCHMARK
+
+    def test_benchmarks(self):
+        results = run_benchmarks(self.layer['portal'].benchmark)
+        report(results)
+        size = '%sx%s' % (FOLDERS, ITEMS)
+        baselines = {}
+        if os.path.exists(BASELINE):
+            baselines = json.loads(open(BASELINE).read())
+        if os.environ.get('BENCHMARK_SAVE'):
+            baselines[size] = results
+            fp = open(BASELINE, 'w')
+            try:
+                fp.write(json.dumps(baselines, indent=2, sort_keys=True))
+            finally:
+                fp.close()
+            return
+        if size not in baselines:
+            self.fail(
+                'no baseline for a site of %s in %s, run with BENCHMARK_SAVE=1 '
+                'to create it' % (size, BASELINE))
+        slower = regressions(results, baselines[size])
+        self.failIf(slower, 'slower than the baseline: %s' % (
+            ', '.join(slower),))
@@ -3,8 +3,10 @@ import os
 import unittest
 import multiprocessing
 import tempfile
+import threading
 import shutil
 import urllib2
+import zlib
 
 try:
     import json
@@ -12,6 +14,10 @@ except ImportError:
     import simplejson as json
 
 import transaction
+from DateTime import DateTime
+from Missing import MV
+from zope.lifecycleevent import ObjectMovedEvent, ObjectRemovedEvent
+from zope.component.hooks import getSite, setSite
 
 from plone.app.testing import PloneSandboxLayer
 from plone.testing import z2
@@ -22,8 +28,18 @@ from Products.CMFCore.utils import getToolByName
 
 from .. import serializers
 from .. import service
+from .. import cache
+from .. import compression
+from .. import context
+from .. import dump
+from .. import html
+from .. import jobs
+from .. import offline
+from .. import profiling
 from .. import jsonutils
+from .. import walker
 from ..interfaces import ISerializer
+from ..browser.views import JobView, flag, not_modified
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -51,6 +67,309 @@ class TestCase(unittest.TestCase):
             return super(TestCase, self).assertEquals(one, other)
 
 
+class SerializerTableTestCase(TestCase):
+    def test_table(self):
+        table = serializers.ATFolderSerializer.serializer_table()
+        self.assertEquals(
+            [key for (key, func) in table],
+            ['description', '_children', 'path', 'title', 'state'])
+        self.assert_(
+            serializers.ATFolderSerializer.__dict__['_serializer_table'] is
+            table)
+
+    def test_override(self):
+        class Serializer(serializers.ItemSerializer):
+            @serializers.serializer_for('title')
+            def serialize_title(self):
+                return 'overridden'
+
+        table = dict(Serializer.serializer_table())
+        self.assertEquals(table['title'], Serializer.serialize_title.im_func)
+        self.assertEquals(
+            dict(serializers.ItemSerializer.serializer_table())['title'],
+            serializers.ItemSerializer.serialize_title.im_func)
+
+
+class DimensionsTestCase(TestCase):
+    def test_dimensions(self):
+        for url in ('/plone/news/leadImage', '/plone/full', ''):
+            dimensions = serializers.Dimensions(url)
+            expected = dict([
+                (d, ('%s_%s' % (url, d)).rstrip('_full'))
+                for d in serializers.DIMENSIONS])
+            self.assertEquals(dict(dimensions), expected)
+            self.assertEquals(
+                json.loads(jsonutils.to_json({'dimensions': dimensions})),
+                {'dimensions': expected})
+
+
+class HtmlTestCase(TestCase):
+    def test_html_to_text(self):
+        self.assertEquals(
+            html.html_to_text(
+                '<div><p>Some <a href="http://foo/">link</a></p>'
+                '<ul><li>one</li><li>two <b>bold</b></li></ul></div>tail'),
+            u'Some link (http://foo/)\n\n* one\n* two bold\n\n\ntail')
+        deep = '<div>' * 500 + 'deep' + '</div>' * 500
+        self.assertEquals(html.html_to_text(deep), u'deep' + u'\n' * 500)
+
+
+    def test_urls_from_html(self):
+        self.assertEquals(
+            html.urls_from_html(
+                '<a href="foo">foo</a><a name="bar">bar</a><img src="baz">'
+                '<video><source src="qux.webm"><source src="qux.mp4"></video>'
+                '<audio src="quux.mp3"><source src="quux.ogg"></audio>'),
+            {'a': [u'foo'], 'img': [u'baz'], 'embed': [], 'iframe': [],
+                'audio': [[u'quux.mp3']],
+                'video': [[u'qux.webm', u'qux.mp4']]})
+
+
+class JsonUtilsTestCase(TestCase):
+    def test_backend(self):
+        # simplejson is only used when configured
+        self.assertEquals(jsonutils._load_backend(None).__name__, 'json')
+
+    def test_raw_json(self):
+        data = {
+            'items': [jsonutils.RawJSON('{"id": "foo"}'), 1],
+            'raw': jsonutils.RawJSON('"\\u0000"'),
+        }
+        self.assertEquals(
+            json.loads(jsonutils.to_json(data)),
+            {'items': [{'id': 'foo'}, 1], 'raw': u'\x00'})
+
+    def test_get_json_serializer(self):
+        class MyDateTime(DateTime):
+            pass
+
+        self.assertEquals(
+            jsonutils.get_json_serializer(MyDateTime),
+            jsonutils.datetime_to_json)
+        self.assertEquals(jsonutils.get_json_serializer(DummyObject), None)
+
+        serializer = lambda obj: 'dummy'
+        jsonutils.json_serializers.append((DummyObject, serializer))
+        try:
+            self.assertEquals(
+                jsonutils.get_json_serializer(DummyObject), serializer)
+            self.assertEquals(
+                jsonutils.to_json([DummyObject()]), '["dummy"]')
+        finally:
+            jsonutils.json_serializers.pop()
+        self.assertEquals(jsonutils.get_json_serializer(DummyObject), None)
+
+
+class CompressionTestCase(TestCase):
+    def test_negotiate(self):
+        self.assertEquals(compression.negotiate(None), None)
+        self.assertEquals(compression.negotiate('identity'), None)
+        self.assertEquals(compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertEquals(compression.negotiate('gzip;q=0'), None)
+        self.assertEquals(
+            compression.negotiate('*'), compression.codecs()[0])
+
+    def test_compress_iter(self):
+        chunks = ['{"foo": ', '"bar"}'] * 100
+        for codec in compression.codecs():
+            compressed = ''.join(compression.compress_iter(chunks, codec))
+            if codec == 'gzip':
+                decompressed = zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+            else:
+                decompressed = compression.zstandard.ZstdDecompressor(
+                    ).decompressobj().decompress(compressed)
+            self.assertEquals(decompressed, ''.join(chunks))
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        lru = cache.LRUCache(10)
+        lru.set('a', 1, 4)
+        lru.set('b', 2, 4)
+        self.assertEquals(lru.get('a'), 1)
+        lru.set('c', 3, 4)
+        self.assertEquals(lru.get('b'), None)
+        self.assertEquals(lru.get('a'), 1)
+        self.assertEquals(lru.get('c'), 3)
+        lru.set('d', 4, 11)
+        self.assertEquals(lru.get('d'), None)
+        self.assertEquals(
+            lru.stats(),
+            {'hits': 3, 'misses': 2, 'evictions': 1, 'items': 2, 'size': 8,
+                'max_size': 10})
+
+    def test_estimate_size(self):
+        data = {'id': 'foo', 'subject': ('bar', 'baz'), 'width': 10}
+        size = len(jsonutils.to_json(data))
+        self.assert_(size <= cache.estimate_size(data) <= size * 1.5)
+
+    def test_cached_to_dict(self):
+        instance = DummyObject(
+            id='item1', title='Item 1', meta_type='Dummy',
+            _p_jar=object(), _p_changed=False, _p_serial='\0' * 7 + '\1',
+            getId=lambda: 'item1', portal_url=lambda: 'http://nohost',
+            getPhysicalPath=lambda: ('', 'plone', 'item1'))
+        cache.serialized.clear()
+        try:
+            expected = serializers.ItemSerializer(instance).to_dict()
+            self.assertEquals(
+                serializers.ItemSerializer(instance).cached_to_dict(),
+                expected)
+            instance.title = 'Changed'
+            self.assertEquals(
+                serializers.ItemSerializer(instance).cached_to_dict(),
+                expected)
+            self.assertEquals(cache.serialized.hits, 1)
+
+            instance._p_serial = '\0' * 7 + '\2'
+            self.assertEquals(
+                serializers.ItemSerializer(instance).cached_to_dict()[
+                    'title'],
+                'Changed')
+            self.assertEquals(cache.serialized.misses, 2)
+
+            serializer = serializers.ItemSerializer(instance)
+            data = serializer.cached_to_dict()
+            self.assertEquals(
+                serializer.cached_to_json(data), jsonutils.to_json(data))
+            hits = cache.serialized.hits
+            self.assertEquals(
+                serializer.to_fragment().json, jsonutils.to_json(data))
+            self.assertEquals(cache.serialized.hits, hits + 2)
+        finally:
+            cache.serialized.clear()
+
+
+class WalkerTestCase(TestCase):
+    def test_release(self):
+        calls = []
+        jar = DummyObject(cacheGC=lambda: calls.append('gc'))
+
+        def serializer(changed=False):
+            return DummyObject(instance=DummyObject(
+                _p_jar=jar, _p_changed=changed,
+                _p_deactivate=lambda: calls.append('deactivate')))
+        interval = walker.CACHE_GC_INTERVAL
+        walker.CACHE_GC_INTERVAL = 2
+        try:
+            w = walker.Walker()
+            w._release(serializer())
+            w._release(serializer(changed=True))
+            self.assertEquals(calls, ['deactivate', 'gc'])
+            walker.Walker(deactivate=False)._release(serializer())
+            self.assertEquals(calls, ['deactivate', 'gc'])
+        finally:
+            walker.CACHE_GC_INTERVAL = interval
+
+
+    def test_paging(self):
+        tree = {'root': ['a', 'b', 'c'], 'b': ['b1', 'b2']}
+        expected = ['root', 'a', 'b', 'b1', 'b2', 'c']
+
+        def pages(**limits):
+            ret = []
+            start = None
+            while True:
+                w = walker.Walker(start=start, **limits)
+                ret.append([
+                    data['id'] for (path, serializer, data, parent)
+                    in w.iter_objects(TreeSerializer(tree, 'root'))
+                    if not w.is_ancestor(path)])
+                start = w.continuation
+                if start is None:
+                    return ret
+                self.assert_(len(ret) <= len(expected), 'no progress')
+
+        self.assertEquals(
+            pages(max_objects=1),
+            [['root'], ['a'], ['b'], ['b1'], ['b2'], ['c']])
+        self.assertEquals(
+            sum(pages(max_objects=2), []), expected)
+        self.assertEquals(sum(pages(max_bytes=1), []), expected)
+
+        w = walker.Walker(max_objects=1)
+        data = json.loads(''.join(w.iter_json(TreeSerializer(tree, 'root'))))
+        self.assertEquals(data['_continuation'], 'a:0')
+        w = walker.Walker(max_objects=1, start=w.continuation)
+        data = json.loads(''.join(w.iter_json(TreeSerializer(tree, 'root'))))
+        self.assertEquals(
+            [child['id'] for child in data['_children']], ['a'])
+        self.assertEquals(data['_continuation'], 'b:1')
+
+        # the start object was removed, continue with its next sibling
+        tree = {'root': ['a', 'c'], 'b': ['b1', 'b2']}
+        w = walker.Walker(start='b/b1:1,0')
+        self.assertEquals(
+            [data['id'] for (path, serializer, data, parent)
+                in w.iter_objects(TreeSerializer(tree, 'root'))],
+            ['root', 'c'])
+
+
+class TreeSerializer(object):
+    """ serializer of a tree of dummy objects, tree maps ids to child ids
+    """
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+        self.instance = DummyObject()
+
+    def cached_to_dict(self):
+        ret = {'id': self.id}
+        if self.id in self.tree:
+            ret['_children'] = list(self.tree[self.id])
+        return ret
+
+    def cached_to_json(self, data):
+        return jsonutils.to_json(data)
+
+    def child_serializer(self, childid):
+        return TreeSerializer(self.tree, childid)
+
+
+class ConditionalGetTestCase(TestCase):
+    def test_not_modified(self):
+        self.assert_(not_modified('"foo"', None, '"foo"', 0))
+        self.assert_(not_modified('"bar", W/"foo"', None, '"foo"', 0))
+        self.assert_(not_modified('*', None, '"foo"', 0))
+        self.failIf(not_modified('"bar"', None, '"foo"', 0))
+        self.assert_(not_modified(
+            None, 'Sun, 06 Nov 1994 08:49:37 GMT', '"foo"', 784111777.5))
+        self.failIf(not_modified(
+            None, 'Sun, 06 Nov 1994 08:49:37 GMT', '"foo"', 784111778))
+        self.failIf(not_modified(None, 'garbage', '"foo"', 784111777))
+        # If-None-Match wins
+        self.failIf(not_modified(
+            '"bar"', 'Sun, 06 Nov 1994 08:49:37 GMT', '"foo"', 784111777))
+
+
+class DumpTestCase(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.settings = dump.DUMP_DIRECTORY, dump.DUMP_MAX_SIZE
+        dump.DUMP_DIRECTORY = self.tempdir
+        dump.DUMP_MAX_SIZE = 10
+
+    def tearDown(self):
+        dump.DUMP_DIRECTORY, dump.DUMP_MAX_SIZE = self.settings
+        shutil.rmtree(self.tempdir)
+
+    def test_dump(self):
+        self.assertEquals(list(dump.dump(['[1', ', 2]'])), ['[1', ', 2]'])
+        self.assertEquals(
+            list(dump.dump(['[1111111', ', 2222222]'])),
+            ['[1111111', ', 2222222]'])
+        for i in range(50):
+            if os.listdir(self.tempdir):
+                break
+            time.sleep(0.1)
+        # give the thread the chance to finish writing
+        time.sleep(0.1)
+        filenames = os.listdir(self.tempdir)
+        self.assertEquals(len(filenames), 1)
+        self.assertEquals(
+            open(os.path.join(self.tempdir, filenames[0])).read(), '[1, 2]')
+
+
 class UnregisteredSerializersTestCase(TestCase):
     layer = PLONE_INTEGRATION_TESTING
 
@@ -238,6 +557,139 @@ class SerializersTestCase(TestCase):
                 'state': None,
             })
 
+    def test_field_plan(self):
+        _createObjectByType(
+            'News Item', self.folder2, id='newsitem3', title='News Item 3')
+        plan = ISerializer(self.newsitem1).field_plan()
+        self.assert_(ISerializer(self.folder2.newsitem3).field_plan() is plan)
+        self.assert_(ISerializer(self.document1).field_plan() is not plan)
+        self.assertEquals(
+            dict((field_id, processor)
+                for (field_id, field, processor) in plan)['relatedItems'],
+            '_process_references')
+
+        # schemaextenders may be registered in the site's component registry
+        site = getSite()
+        setSite(None)
+        try:
+            self.assert_(ISerializer(self.newsitem1).field_plan() is not plan)
+        finally:
+            setSite(site)
+        self.assert_(ISerializer(self.newsitem1).field_plan() is plan)
+
+        serializers.clear_field_plans()
+        self.assert_(ISerializer(self.newsitem1).field_plan() is not plan)
+
+    def test_child_path(self):
+        serializer = ISerializer(self.folder2)
+        child = serializer.child_serializer('document1')
+        self.assertEquals(
+            child.physical_path(), self.document1.getPhysicalPath())
+        self.assertEquals(
+            child.url(child.instance), serializer.url(self.document1))
+
+    def test_export_context(self):
+        serializer = serializers.FolderSerializer(self.portal)
+        child = serializer.child_serializer('folder2')
+        self.assert_(child.export_context is serializer.export_context)
+        self.assertEquals(child.to_dict()['state'], 'published')
+        self.assertEquals(
+            serializer.export_context.workflow_chain(self.folder2),
+            ('folder_workflow',))
+        self.assertEquals(
+            serializer.export_context.review_state(
+                self.portal.getPhysicalPath(), 'folder2'),
+            'published')
+
+        profile = profiling.Profile()
+        serializer = serializers.get_serializer(
+            self.folder2, context.ExportContext(self.folder2, profile=profile))
+        walker.Walker().to_dict(serializer)
+        self.assertEquals(profile.counters['serialized'], 3)
+        self.assertEquals(serializer.portal_url, self.portal.portal_url())
+
+    def test_rich_text_processors(self):
+        self.document1.setText('<p><a href="http://foo/">foo</a></p>')
+        serializer = ISerializer(self.document1)
+        self.assert_('text_urls' not in serializer.to_dict())
+        serializer.rich_text_processors = ('serialize_rich_text_urls',)
+        self.assertEquals(
+            serializer.to_dict()['text_urls']['a'], [u'http://foo/'])
+        serializer.export_context = serializer.export_context.projected(
+            exclude=['text_urls'])
+        data = serializer.to_dict()
+        self.assert_('text_urls' not in data)
+        self.assert_('text' in data)
+
+    def test_profile(self):
+        profile = profiling.Profile()
+        data = json.loads(service.service.render(
+            self.folder2, recursive=True, profile=profile))
+        self.assertEquals(len(data['_children']), 2)
+        timings = dict([
+            ((timing['serializer'], timing['kind'], timing['key']), timing)
+            for timing in profile.to_list()])
+        self.assertEquals(
+            timings[('ATFolderSerializer', 'method', 'state')]['calls'], 1)
+        self.assert_(('ATFolderSerializer', 'json', '') in timings)
+        self.assert_(
+            [key for key in timings if key[1:] == ('field', 'text')])
+        self.assertEquals(len(profile.to_list(limit=1)), 1)
+        self.assertEquals(
+            sum(profile.counters.values()), 3)
+
+    def test_validators(self):
+        last_modified, token = service.service.validators(self.folder2, True)
+        self.assertEquals(
+            service.service.validators(self.folder2, True),
+            (last_modified, token))
+        self.assertNotEquals(
+            service.service.validators(self.folder2, False)[1], token)
+        _createObjectByType(
+            'Document', self.folder2, id='document2', title='Document 2')
+        self.assertNotEquals(
+            service.service.validators(self.folder2, True)[1], token)
+
+        # removals don't change the modification dates of what's left
+        last_modified = service.service.validators(self.folder2, True)[0]
+        time.sleep(0.01)
+        service.record_tombstone(
+            self.newsitem1,
+            ObjectRemovedEvent(self.newsitem1, self.folder2, 'newsitem1'))
+        self.assert_(
+            service.service.validators(self.folder2, True)[0] > last_modified)
+
+    def test_projection(self):
+        data = json.loads(service.service.render(
+            self.folder2, recursive=True, fields=['title', 'state']))
+        self.assertEquals(
+            sorted(data.keys()),
+            ['_children', 'id', 'path', 'state', 'title', 'type'])
+        self.assertEquals(
+            sorted(data['_children'][0].keys()),
+            ['id', 'path', 'state', 'title', 'type'])
+        # values that are objects themselves are serialized completely
+        data = json.loads(service.service.render(
+            self.newsitem1, fields=['image']))
+        self.assert_('title' not in data)
+        for key in ('width', 'height', 'size', 'alt'):
+            self.assert_(key in data['image'], key)
+        data = json.loads(service.service.render(
+            self.newsitem1, exclude=['text', 'image']))
+        self.assert_('text' not in data)
+        self.assert_('image' not in data)
+        self.assertEquals(data['title'], 'News Item 1')
+
+        # the fields are never read
+        serializer = ISerializer(self.document1)
+        serializer.export_context = serializer.export_context.projected(
+            ['title'])
+        plan = serializer.export_context.project(serializer.field_plan())
+        self.assertEquals([field_id for (field_id, f, p) in plan], [])
+        self.assert_(
+            serializer.export_context.project(serializer.field_plan()) is
+            plan)
+
     def test_recursion(self):
         serializer = ISerializer(self.folder2)
         data = serializer.to_dict(recursive=True)
@@ -245,6 +697,285 @@ class SerializersTestCase(TestCase):
         self.assertEquals(data['_children'][0]['id'], 'document1')
         self.assertEquals(data['_children'][1]['id'], 'newsitem1')
 
+    def test_stream(self):
+        expected = service.service.render(self.folder2, recursive=True)
+        chunks = list(service.service.render_iter(self.folder2, True))
+        self.assert_(len(chunks) > 1)
+        self.assertEquals(''.join(chunks), expected)
+        self.assertEquals(
+            jsonutils.to_json(ISerializer(self.folder2).to_dict(True)),
+            expected)
+
+        written = []
+        service.service.stream(self.folder2, written.append, recursive=True)
+        self.assertEquals(''.join(written), expected)
+        self.assertEquals(
+            ''.join(service.service.render_iter(self.folder2)),
+            service.service.render(self.folder2))
+
+    def test_walker_limits(self):
+        w = walker.Walker(max_depth=0)
+        data = w.to_dict(ISerializer(self.folder2))
+        self.assertEquals(data['_children'], ['document1', 'newsitem1'])
+
+        w = walker.Walker(max_objects=2)
+        data = json.loads(
+            ''.join(w.iter_json(ISerializer(self.folder2))))
+        self.assertEquals(w.continuation, 'newsitem1:1')
+        self.assertEquals(data['_continuation'], 'newsitem1:1')
+        self.assertEquals(
+            [child['id'] for child in data['_children']], ['document1'])
+
+        w = walker.Walker(start=w.continuation)
+        data = w.to_dict(ISerializer(self.folder2))
+        self.assertEquals(w.continuation, None)
+        self.assert_('_continuation' not in data)
+        self.assertEquals(
+            [child['id'] for child in data['_children']], ['newsitem1'])
+
+        w = walker.Walker(max_bytes=1)
+        data = w.to_dict(ISerializer(self.folder2))
+        self.assertEquals(data['_children'], [])
+        self.assertEquals(data['_continuation'], 'document1:0')
+
+    def test_jsonl(self):
+        lines = list(service.service.render_jsonl_iter(
+            self.folder2, recursive=True))
+        self.assertEquals(len(lines), 3)
+        data = [json.loads(line) for line in lines]
+        self.assertEquals(
+            [(item['path'], item['_parent']) for item in data],
+            [('/plone/folder2', None),
+                ('/plone/folder2/document1', '/plone/folder2'),
+                ('/plone/folder2/newsitem1', '/plone/folder2')])
+        self.assertEquals(data[0]['_children'], ['document1', 'newsitem1'])
+        del data[1]['_parent']
+        self.assertEquals(
+            data[1],
+            json.loads(jsonutils.to_json(
+                ISerializer(self.document1).to_dict())))
+
+        w = walker.Walker(max_objects=2)
+        lines = list(w.iter_jsonl(ISerializer(self.folder2)))
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(
+            json.loads(lines[-1]), {'_continuation': 'newsitem1:1'})
+
+    def test_jobs(self):
+        directory = jobs.JOBS_DIRECTORY
+        jobs.JOBS_DIRECTORY = tempfile.mkdtemp()
+        try:
+            status = jobs.create(self.folder2)
+            self.assertEquals(status['state'], jobs.QUEUED)
+            status = jobs.run(self.app, status['id'], batch_size=1, sync=False)
+            self.assertEquals(status['state'], jobs.DONE)
+            self.assertEquals(status['objects'], 3)
+            self.assertEquals(status, jobs.read_status(status['id']))
+            expected = open(jobs.artifact_path(status['id'])).read()
+            self.assertEquals(
+                [json.loads(line)['id'] for line in expected.splitlines()],
+                ['folder2', 'document1', 'newsitem1'])
+
+            # a job that was interrupted after its first checkpoint, halfway
+            # the next batch, resumes from the checkpoint
+            status = jobs.create(self.folder2)
+            fp = open(jobs.artifact_path(status['id']), 'wb')
+            jobs.run_batch(self.folder2, status, fp, batch_size=1)
+            fp.write('{"id": "docum')
+            fp.close()
+            status['state'] = jobs.RUNNING
+            jobs.write_status(status)
+            self.assertEquals(status['checkpoint'], 'document1:0')
+            status = jobs.run(self.app, status['id'], batch_size=1, sync=False)
+            self.assertEquals(status['objects'], 3)
+            self.assertEquals(
+                open(jobs.artifact_path(status['id'])).read(), expected)
+
+            # a job that is being run elsewhere is left alone
+            status = jobs.create(self.folder2)
+            lockfile = jobs.lock(status['id'])
+            try:
+                self.failIf(jobs.is_stale(status))
+                self.assertEquals(
+                    jobs.run(self.app, status['id'], sync=False)['state'],
+                    jobs.QUEUED)
+            finally:
+                lockfile.close()
+            self.assert_(jobs.is_stale(status))
+
+            # jobs run in threads without a site, which collections need
+            _createObjectByType(
+                'Collection', self.folder2, id='collection2', title='News')
+            self.folder2.collection2.setQuery(
+                [{'i': 'portal_type',
+                    'o': 'plone.app.querystring.operation.selection.is',
+                    'v': ['News Item']}])
+            status = jobs.create(self.folder2)
+            errors = []
+
+            def run():
+                try:
+                    jobs.run(self.app, status['id'], sync=False)
+                except Exception, e:
+                    errors.append(e)
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+            self.assertEquals(errors, [])
+            lines = [
+                json.loads(line) for line in
+                open(jobs.artifact_path(status['id'])).readlines()]
+            self.assertEquals(
+                [result['id'] for result in lines[-1]['results']],
+                ['newsitem1', 'newsitem2'])
+
+            # the view parses the recursive flag
+            self.assertEquals(flag(None, default=True), True)
+            self.assertEquals(flag('False'), False)
+            self.assertEquals(flag('1'), True)
+            submit = jobs.submit
+            jobs.submit = lambda db, jobid: True
+            transaction.savepoint(optimistic=True)
+            try:
+                request = self.layer['request']
+                request.environ['REQUEST_METHOD'] = 'POST'
+                request.form['recursive'] = '0'
+                status = json.loads(JobView(self.folder2, request).queue())
+                self.assertEquals(status['recursive'], False)
+                self.assertEquals(
+                    jobs.read_status(status['id'])['recursive'], False)
+                del request.form['recursive']
+                status = json.loads(JobView(self.folder2, request).queue())
+                self.assertEquals(status['recursive'], True)
+            finally:
+                jobs.submit = submit
+                request.environ['REQUEST_METHOD'] = 'GET'
+
+            self.assertRaises(ValueError, jobs.read_status, '../etc')
+        finally:
+            shutil.rmtree(jobs.JOBS_DIRECTORY)
+            jobs.JOBS_DIRECTORY = directory
+
+    def test_brains(self):
+        data = json.loads(''.join(service.service.render_brains_iter(
+            self.folder2, fields=['Subject', 'text'], batch_size=2)))
+        self.assertEquals(
+            [item['path'] for item in data],
+            ['/plone/folder2', '/plone/folder2/document1',
+                '/plone/folder2/newsitem1'])
+        self.assertEquals(
+            data[1],
+            {'type': 'ATDocument',
+                'id': 'document1',
+                'path': '/plone/folder2/document1',
+                'portal_type': 'Document',
+                'state': None,
+                'modification_date': jsonutils.datetime_to_json(
+                    self.document1.modified()),
+                'title': 'Document 1',
+                'description': '<p>Description.</p>',
+                'Subject': [],
+                'text': '',
+                })
+        self.assert_('text' not in data[0])
+        self.assertEquals(data[0]['state'], 'published')
+
+        # objects with paths that merely start with the same characters are
+        # not below the object
+        _createObjectByType('Folder', self.portal, id='folder20')
+        catalog = getToolByName(self.portal, 'portal_catalog')
+        self.assertEquals(
+            [catalog.getpath(rid) for rid in
+                service.catalog_rids(catalog, '/plone/folder2')],
+            ['/plone/folder2', '/plone/folder2/document1',
+                '/plone/folder2/newsitem1'])
+
+        # the catalog stores Missing.Value for columns without a value
+        self.assertEquals(
+            serializers.BrainSerializer(
+                DummyObject(review_state=MV)).column_value('review_state'),
+            None)
+
+        # expired objects are exported too
+        self.document1.setExpirationDate(DateTime() - 1)
+        self.document1.reindexObject()
+        data = json.loads(''.join(
+            service.service.render_brains_iter(self.folder2)))
+        self.assert_('/plone/folder2/document1' in [
+            item['path'] for item in data])
+
+    def test_delta(self):
+        since = DateTime()
+        time.sleep(1)
+        self.document1.setTitle('Document 1 changed')
+        self.document1.reindexObject()
+        parent = self.folder2
+        self.folder2.manage_delObjects(['newsitem1'])
+        service.record_tombstone(
+            self.newsitem1,
+            ObjectRemovedEvent(self.newsitem1, parent, 'newsitem1'))
+
+        data = json.loads(service.service.render_delta(self.portal, since))
+        self.assertEquals(
+            [item['path'] for item in data['modified']],
+            ['/plone/folder2/document1'])
+        self.assertEquals(
+            data['modified'][0]['title'], 'Document 1 changed')
+        self.assertEquals(data['deleted'], ['/plone/folder2/newsitem1'])
+
+        data = json.loads(service.service.render_delta(
+            self.portal, jsonutils.json_to_datetime(data['until'])))
+        self.assertEquals(data['deleted'], [])
+
+        # moves don't change the modification date, the moved objects (and
+        # their children) are part of the delta anyway
+        since = jsonutils.json_to_datetime(data['until'])
+        time.sleep(1)
+        service.record_tombstone(
+            self.folder2,
+            ObjectMovedEvent(
+                self.folder2, self.portal, 'folder2', self.portal, 'folder3'))
+        transaction.savepoint(optimistic=True)
+        self.portal.manage_renameObject('folder2', 'folder3')
+        data = json.loads(service.service.render_delta(self.portal, since))
+        self.assertEquals(
+            data['moved'], [{'from': '/plone/folder2', 'to': '/plone/folder3'}])
+        self.assert_('/plone/folder2' in data['deleted'])
+        self.assertEquals(
+            [item['path'] for item in data['modified']],
+            ['/plone/folder3', '/plone/folder3/document1'])
+
+    def test_offline_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.assert_(context.find_site(self.folder2) is self.portal)
+            manifest = offline.export(self.folder2, directory, shards=2)
+            self.assertEquals(manifest['objects'], 3)
+            self.assertEquals(manifest['root']['id'], 'folder2')
+            lines = {}
+            for shard in manifest['shards']:
+                lines[shard['file']] = open(
+                    os.path.join(directory, shard['file'])).readlines()
+                self.assertEquals(
+                    len(lines[shard['file']]), len(shard['children']))
+                self.assertEquals(
+                    shard['file'],
+                    offline.shard_filename(
+                        offline.shard_for(shard['children'][0], 2)))
+            data = [
+                json.loads(line) for filelines in lines.values()
+                for line in filelines]
+            self.assertEquals(
+                sorted([item['id'] for item in data]),
+                ['document1', 'newsitem1'])
+            self.assertEquals(
+                json.loads(open(
+                    os.path.join(directory, 'manifest.json')).read())['root'],
+                json.loads(jsonutils.to_json(
+                    ISerializer(self.folder2).to_dict())))
+        finally:
+            shutil.rmtree(directory)
+
     def test_archetypes_reference_field(self):
         serializer = ISerializer(self.newsitem2)
         data = serializer.to_dict(recursive=True)
@@ -256,6 +987,45 @@ class SerializersTestCase(TestCase):
                 'id': 'newsitem1',
                 }])
 
+    def test_references_from_uids(self):
+        uids = [self.newsitem2.UID(), 'nonexistent', self.newsitem1.UID()]
+        export_context = context.ExportContext(self.portal)
+        self.assertEquals(
+            [item['id'] for item in
+                serializers.ReferenceSerializer.from_uids(
+                    export_context, uids)],
+            ['newsitem2', 'newsitem1'])
+        self.assertEquals(
+            serializers.ReferenceSerializer.from_uids(export_context, []), [])
+
+    def test_cached_references(self):
+        def cache_key():
+            return ('newsitem2',)
+        cache.serialized.clear()
+        try:
+            serializer = ISerializer(self.newsitem2)
+            serializer.cache_key = cache_key
+            data = serializer.cached_to_dict()
+            self.assertEquals(
+                [item['path'] for item in data['relatedItems']],
+                ['/plone/folder2/newsitem1'])
+            serializer.cached_to_json(data)
+            transaction.savepoint(optimistic=True)
+            self.folder2.manage_renameObject('newsitem1', 'newsitem3')
+            serializer = ISerializer(self.newsitem2)
+            serializer.cache_key = cache_key
+            data = serializer.cached_to_dict()
+            self.assertEquals(cache.serialized.hits, 1)
+            self.assertEquals(
+                [item['path'] for item in data['relatedItems']],
+                ['/plone/folder2/newsitem3'])
+            self.assertEquals(
+                json.loads(serializer.cached_to_json(data))['relatedItems'][
+                    0]['path'],
+                '/plone/folder2/newsitem3')
+        finally:
+            cache.serialized.clear()
+
     def test_collection(self):
         serializer = ISerializer(self.collection1)
         data = serializer.to_dict(recursive=True)
@@ -266,3 +1036,25 @@ class SerializersTestCase(TestCase):
                 {'type': 'Reference', 'subtype': 'ATNewsItem',
                     'path': '/plone/newsitem2', 'id': 'newsitem2'},
                 ])
+
+        # the results are not served from the cache
+        def cache_key():
+            return ('collection1',)
+        cache.serialized.clear()
+        try:
+            serializer = ISerializer(self.collection1)
+            serializer.cache_key = cache_key
+            self.assertEquals(len(serializer.cached_to_dict()['results']), 2)
+            _createObjectByType(
+                'News Item', self.portal, id='newsitem3', title='News Item 3')
+            serializer = ISerializer(self.collection1)
+            serializer.cache_key = cache_key
+            data = serializer.cached_to_dict()
+            self.assertEquals(cache.serialized.hits, 1)
+            self.assert_('newsitem3' in [
+                result['id'] for result in data['results']])
+            self.assertEquals(
+                json.loads(serializer.cached_to_json(data))['results'],
+                json.loads(jsonutils.to_json(data['results'])))
+        finally:
+            cache.serialized.clear()
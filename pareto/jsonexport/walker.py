@@ -0,0 +1,340 @@
+from Acquisition import aq_base
+
+import jsonutils
+
+try:
+    from pareto.jsonexport.config import CACHE_GC_INTERVAL
+except ImportError:
+    # the amount of objects after which the ZODB cache is garbage collected
+    # during a walk, 0 disables
+    CACHE_GC_INTERVAL = 1000
+
+# placeholder for the '_children' value while streaming, the encoded JSON of
+# a container is split on this to write the children in between
+CHILDREN_MARKER = u'\x00pareto.jsonexport.children\x00'
+CHILDREN_MARKER_JSON = jsonutils.to_json(CHILDREN_MARKER)
+
+
+def format_token(path, stack):
+    """ return a continuation token for the object at path
+
+        stack is the stack of the walk, the frames of which have the
+        ChildIds of the ancestors of the object as second item, the token
+        is the path, a colon and the positions of the objects on the path
+        among their siblings (which are used if an object no longer exists
+        when the walk is continued), e.g. 'news/item-1:0,3'
+    """
+    return '%s:%s' % (
+        '/'.join(path),
+        ','.join([str(frame[1].index) for frame in stack]))
+
+
+def parse_token(token):
+    """ return (path, positions) for a continuation token
+
+        positions is None for tokens without positions (plain paths)
+    """
+    if not token:
+        return [], None
+    positions = None
+    if ':' in token:
+        token, positions = token.rsplit(':', 1)
+        try:
+            positions = [int(position) for position in positions.split(',')]
+        except ValueError:
+            positions = None
+    path = token.strip('/').split('/')
+    if positions is not None and len(positions) != len(path):
+        positions = None
+    return path, positions
+
+
+class ChildIds(object):
+    """ iterator over the child ids of a container, from position start
+
+        'index' is the position of the last id returned
+    """
+    def __init__(self, ids, start=0):
+        self.ids = ids
+        self.index = start - 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.index + 1 >= len(self.ids):
+            raise StopIteration
+        self.index += 1
+        return self.ids[self.index]
+
+
+class Walker(object):
+    """ serialize a tree of objects without recursion
+
+        the tree is walked depth-first using an explicit stack, so deep
+        hierarchies don't hit Python's recursion limit, and the amount of
+        work can be limited:
+
+        * max_depth - containers deeper than this have their '_children'
+          serialized as a list of ids, as in non-recursive mode
+
+        * max_objects - the maximum amount of objects to serialize
+
+        * max_bytes - the (approximate) maximum size of the JSON, the walk
+          stops after the first object that exceeds the limit
+
+        when the walk is stopped because of max_objects or max_bytes,
+        'continuation' is set to a token (the path, relative to the root, of
+        the next object to serialize, followed by the positions of the
+        objects on the path among their siblings, see format_token()),
+        which is also stored as '_continuation' on the root object. Passing
+        the token as 'start' to a new walker makes it skip everything before
+        that object, so the tree can be retrieved in pages (ancestors of the
+        start object are serialized again on every page, with only the
+        remaining children in their '_children', but they don't count
+        towards max_objects, and at least one object other than the
+        ancestors is serialized on every page, so a walk always progresses).
+
+        to keep the ZODB cache from filling up with the whole tree, objects
+        (except the root) are deactivated (turned into ghosts) once they and
+        their children are serialized, unless they have unsaved changes, and
+        the cache is garbage collected every CACHE_GC_INTERVAL objects,
+        pass deactivate=False to leave the objects alone
+    """
+    def __init__(
+            self, max_depth=None, max_objects=None, max_bytes=None,
+            start=None, deactivate=True):
+        self.max_depth = max_depth
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.start, self.start_positions = parse_token(start)
+        self.deactivate = deactivate
+        self.objects = 0
+        self.bytes = 0
+        self.continuation = None
+        self._released = 0
+
+    def iter_json(self, serializer, recursive=True):
+        """ generate the JSON for the tree starting at serializer, in chunks
+        """
+        stack = []
+        yield self._count(self._open_json(serializer, recursive, [], stack))
+        while stack:
+            parent, childids, tail, path, first = frame = stack[-1]
+            childid = next(childids, None)
+            if childid is None:
+                stack.pop()
+                if stack:
+                    self._release(parent)
+                yield self._count(']' + self._close_json(tail, stack))
+                continue
+            if self._exhausted():
+                self.continuation = format_token(path + [childid], stack)
+                while stack:
+                    tail = stack.pop()[2]
+                    yield ']' + self._close_json(tail, stack)
+                break
+            if first:
+                frame[4] = False
+                sep = ''
+            else:
+                sep = ', '
+            yield self._count(
+                sep + self._open_json(
+                    parent.child_serializer(childid), True, path + [childid],
+                    stack))
+
+    def _open_json(self, serializer, recursive, path, stack):
+        data = serializer.cached_to_dict()
+        self._counted(path)
+        children = self._children(data, recursive, path)
+        if children is None:
+            ret = serializer.cached_to_json(data)
+            if path:
+                self._release(serializer)
+            return ret
+        data['_children'] = CHILDREN_MARKER
+        head, tail = serializer.cached_to_json(data).split(
+            CHILDREN_MARKER_JSON, 1)
+        stack.append([serializer, children, tail, path, True])
+        return head + '['
+
+    def _close_json(self, tail, stack):
+        if stack or self.continuation is None:
+            return tail
+        # root object of an interrupted walk, add the continuation token
+        return '%s, "_continuation": %s}' % (
+            tail[:-1], jsonutils.to_json(self.continuation))
+
+    def expand(self, serializer, data, recursive=True):
+        """ replace the '_children' of data (serializer's dict) by dicts
+
+            returns data
+        """
+        if self.max_bytes is not None:
+            self._count(jsonutils.to_json(data))
+        self._counted([])
+        children = self._children(data, recursive, [])
+        if children is None:
+            return data
+        stack = [(serializer, children, data, [], [])]
+        while stack:
+            parent, childids, parentdata, path, childdicts = stack[-1]
+            childid = next(childids, None)
+            if childid is None:
+                stack.pop()
+                parentdata['_children'] = childdicts
+                if stack:
+                    self._release(parent)
+                continue
+            if self._exhausted():
+                self.continuation = format_token(path + [childid], stack)
+                for frame in stack:
+                    frame[2]['_children'] = frame[4]
+                data['_continuation'] = self.continuation
+                break
+            childpath = path + [childid]
+            child = parent.child_serializer(childid)
+            childdata = child.cached_to_dict()
+            if self.max_bytes is not None:
+                self._count(jsonutils.to_json(childdata))
+            self._counted(childpath)
+            childdicts.append(childdata)
+            children = self._children(childdata, True, childpath)
+            if children is not None:
+                stack.append(
+                    (child, children, childdata, childpath, []))
+            else:
+                self._release(child)
+        return data
+
+    def to_dict(self, serializer, recursive=True):
+        """ return the (nested) dict for the tree starting at serializer
+        """
+        return self.expand(
+            serializer, serializer.cached_to_dict(), recursive)
+
+    def iter_objects(self, serializer, recursive=True, parent=None):
+        """ generate (path, serializer, data, parent) for the tree's objects
+
+            the tree is walked depth-first, path is the list of ids of the
+            object relative to the root, data is the object's non-recursive
+            dict (so '_children' contains ids) and parent the 'path' value
+            of the parent object (the argument for the root object),
+            max_bytes is only enforced if the consumer counts the bytes
+            (as iter_jsonl does)
+        """
+        data = serializer.cached_to_dict()
+        self._counted([])
+        yield [], serializer, data, parent
+        children = self._children(data, recursive, [])
+        if children is None:
+            return
+        stack = [(serializer, children, [], data.get('path'))]
+        while stack:
+            parent, childids, path, parentpath = stack[-1]
+            childid = next(childids, None)
+            if childid is None:
+                stack.pop()
+                if stack:
+                    self._release(parent)
+                continue
+            if self._exhausted():
+                self.continuation = format_token(path + [childid], stack)
+                break
+            childpath = path + [childid]
+            child = parent.child_serializer(childid)
+            data = child.cached_to_dict()
+            self._counted(childpath)
+            yield childpath, child, data, parentpath
+            children = self._children(data, True, childpath)
+            if children is not None:
+                stack.append(
+                    (child, children, childpath, data.get('path')))
+            else:
+                self._release(child)
+
+    def iter_jsonl(self, serializer, recursive=True, parent=None):
+        """ generate the JSON Lines for the tree starting at serializer
+
+            every line contains the JSON of a single object, depth-first,
+            with a '_parent' value containing the path of the parent object
+            (parent for the root object), if the walk is interrupted a last
+            line is added with only a '_continuation' value
+        """
+        for path, serializer, data, parentpath in self.iter_objects(
+                serializer, recursive, parent):
+            yield self.jsonl_line(serializer, data, parentpath)
+        if self.continuation is not None:
+            yield '%s\n' % (
+                jsonutils.to_json({'_continuation': self.continuation}),)
+
+    def jsonl_line(self, serializer, data, parent):
+        """ return the JSON Lines line for data (serializer's dict)
+        """
+        # the '_parent' value is appended to the (cached) JSON of the
+        # object, rather than encoding the data again
+        return self._count('%s, "_parent": %s}\n' % (
+            serializer.cached_to_json(data)[:-1], jsonutils.to_json(parent)))
+
+    def _children(self, data, recursive, path):
+        """ return a ChildIds for the children to walk for data
+
+            returns None if data has no children or shouldn't be expanded
+        """
+        children = data.get('_children')
+        if children is None or not recursive:
+            return None
+        depth = len(path)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return None
+        children = list(children)
+        if self.is_ancestor(path):
+            # on the way to the start object, skip the preceding siblings
+            startid = self.start[depth]
+            if startid in children:
+                return ChildIds(children, children.index(startid))
+            if self.start_positions is not None:
+                # the start object no longer exists, continue with the
+                # object that took its place
+                return ChildIds(children, self.start_positions[depth])
+        return ChildIds(children)
+
+    def is_ancestor(self, path):
+        """ return True if path is that of an ancestor of the start object
+        """
+        depth = len(path)
+        return len(self.start) > depth and path == self.start[:depth]
+
+    def _counted(self, path):
+        # ancestors of the start object were exported on an earlier page
+        if not self.is_ancestor(path):
+            self.objects += 1
+
+    def _release(self, serializer):
+        """ deactivate the instance of serializer, see the class docstring
+        """
+        if not self.deactivate:
+            return
+        instance = aq_base(serializer.instance)
+        jar = getattr(instance, '_p_jar', None)
+        if jar is None:
+            return
+        if not instance._p_changed:
+            instance._p_deactivate()
+        self._released += 1
+        if CACHE_GC_INTERVAL and not self._released % CACHE_GC_INTERVAL:
+            jar.cacheGC()
+
+    def _exhausted(self):
+        if not self.objects:
+            # only ancestors of the start object so far
+            return False
+        return (
+            (self.max_objects is not None and
+                self.objects >= self.max_objects) or
+            (self.max_bytes is not None and self.bytes >= self.max_bytes))
+
+    def _count(self, chunk):
+        self.bytes += len(chunk)
+        return chunk